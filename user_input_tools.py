@@ -8,9 +8,21 @@ except:
     from extronlib import event
     from extronlib.system import File, Wait
 
+import bisect
 import calendar
+import collections
+import collections.abc
+import contextlib
 import datetime
+import functools
+import gzip
 import json
+import re
+import sys
+import threading
+import time
+import types
+import weakref
 
 from keyboard import Keyboard
 from scrolling_table import ScrollingTable
@@ -21,6 +33,22 @@ if not DEBUG:
     print = lambda *a, **k: None
 
 
+def CalendarLocked(func):
+    '''
+    Decorates the UserInputClass methods that use the calendar events,
+        so the button events and the background Waits never change them at the same time
+    :param func: a method of UserInputClass
+    :return:
+    '''
+
+    @functools.wraps(func)
+    def Wrapper(self, *args, **kwargs):
+        with self._calLock:
+            return func(self, *args, **kwargs)
+
+    return Wrapper
+
+
 # UserInput *********************************************************************
 class UserInputClass:
     '''
@@ -30,7 +58,7 @@ class UserInputClass:
     Get a calendar data as a datetime.datetime object: UserInput.get_date(**kwargs)
     etc...
     '''
-    _instances = []  # hold all instances so that instances can request each other to update
+    _broadcaster = None  # DisplayBroadcasterClass shared by all instances so that instances can request each other to update
 
     def __init__(self, TLP):
         self._TLP = TLP
@@ -38,7 +66,9 @@ class UserInputClass:
         self._kb_feedback_btn = None
         self._kb_text_feedback = None
         self._kb_callback = None
-        self._instances.append(self)
+        if UserInputClass._broadcaster is None:
+            UserInputClass._broadcaster = DisplayBroadcasterClass()
+        self._broadcaster.Register(self)
 
         self._list_popup_name = ''
 
@@ -60,6 +90,10 @@ class UserInputClass:
                             popupName=None,
                             limitStringLen=25,
                             btnSubmit=None,
+                            lazyListing=False,  # True lists one directory at a time instead of the whole file system
+                            readAhead=True,  # with lazyListing, also list the subdirectories of the current directory in the background
+                            listingMaxAge=60,  # with lazyListing, seconds before a directory that is shown again is listed again
+                            virtualized=False,  # True keeps only the visible rows in the table, for directories with many entries
                             ):
 
         self._file_explorer_lblMessage = lblMessage
@@ -75,6 +109,10 @@ class UserInputClass:
             btnNavUp,
             limitStringLen=limitStringLen,
             lblMessage=lblMessage,
+            lazyListing=lazyListing,
+            readAhead=readAhead,
+            listingMaxAge=listingMaxAge,
+            virtualized=virtualized,
         )
 
         self._file_explorer_filename = None
@@ -111,11 +149,11 @@ class UserInputClass:
             if 'Delete' in value:
                 if self._dirNav.IsFile(filepath):
                     File.DeleteFile(filepath)
-                    self._dirNav.UpdateData()
+                    self._dirNav.PathRemoved(filepath)
 
                 elif self._dirNav.IsDirectory(filepath):
                     File.DeleteDirRecursive(filepath)
-                    self._dirNav.UpdateData()
+                    self._dirNav.PathRemoved(filepath)
 
             elif 'Make New Directory' == value:
                 self.make_new_directory(
@@ -184,10 +222,7 @@ class UserInputClass:
         if startingDir is not None:
             self._dirNav.SetCurrentDirectory(startingDir)
 
-        if data is None:
-            data = File.ListDirWithSub()
-
-        self._dirNav.UpdateData(data)
+        self._dirNav.UpdateData(data)  # None means the internal file system
         self._file_explorer_getFileCallback = callback
         self._file_explorer_feedback_btn = feedback_btn
         self._file_explorer_passthru = passthru
@@ -222,16 +257,13 @@ class UserInputClass:
                            makeDir=False,
                            # whether to actually create the dir, False will just return the new path to the user, True will actually create the dir in the internal filesystem
                            ):
-        if data is None:
-            data = File.ListDirWithSub()
-
         self._dirNav.SetShowFiles(False)
 
         def getNewDirNameCallback(input, value, passthru3=None):
             newFolderName = value
             currentDir = self._dirNav.GetDir()
             File.MakeDir(currentDir + '/' + newFolderName)
-            self._dirNav.UpdateData()
+            self._dirNav.PathAdded(currentDir + newFolderName + '/')
 
         popup = self._kb_other_popups.get('AlphaNumeric', self._kb_popup_name)
 
@@ -307,13 +339,10 @@ class UserInputClass:
                       ):
         self._dirNav.SetShowFiles(False)
 
-        if data is None:
-            data = File.ListDirWithSub()
-
         if message is None:
             message = 'Select a folder'
 
-        self._dirNav.UpdateData(data)
+        self._dirNav.UpdateData(data)  # None means the internal file system
         self._dirNav.FileSelected = None  # dont do anything when a file is selected. A file should never be selected anyway.
         self._dirNav.UpdateMessage(message)
 
@@ -349,7 +378,10 @@ class UserInputClass:
                        calPopupName=None,
                        startDay=None,
                        maxAgendaWidth=None,  # limit the num of characters on an adgenda. to prevent it word-wrapping
-
+                       maxLoadedMonths=12,  # the number of months of events to keep in memory, older/newer months are loaded when needed
+                       retainMonths=None,  # events older than this many months are moved to the archive, None keeps them all
+                       calendarFormat=2,  # the file format to write, 1 also keeps a calendar.json that older versions of this module can read
+                       indexedMetaKeys=None,  # list of meta keys that self.GetEventsByMeta() can answer quickly, like ['Room Number']
                        ):
         '''
         This func must be called before self.get_date()
@@ -363,6 +395,11 @@ class UserInputClass:
         :param calPopupName:
         :param startDay: int > None assumes 6=sunday
         :param maxAgendaWidth:
+        :param maxLoadedMonths: int >= 5
+        :param retainMonths: int >= 1 or None
+        :param calendarFormat: int 1 or 2 - files in the other format are converted when they are loaded.
+            1 also rewrites all the events to calendar.json after every change, for older versions of this module
+        :param indexedMetaKeys: list of str
         :return:
         '''
 
@@ -380,7 +417,26 @@ class UserInputClass:
         calendar.setfirstweekday(6)  # Start calendar on Sunday
 
         # Create attributes
-        self._wait__calDisplayMonth = Wait(1, self._calDisplayMonth)
+        self._calLock = threading.RLock()  # see CalendarLocked()
+        self._wait__calDisplayMonth = Wait(1, self._calDisplayMonthIfShowing)
+        self._calShowing = calPopupName is None  # a calendar on a page is always showing, a popup is showing after get_date()
+        self._calStorage = CalendarStorageClass('calendar', formatVersion=calendarFormat)
+        self._wait__calWrite = Wait(2, self._WriteCalData)  # the only writer of the calendar files, in the background
+        self._wait__calWrite.Cancel()
+        self._wait__calCompact = Wait(60, self._SaveCalData)  # queues folding the journals into the snapshots
+        self._wait__calCompact.Cancel()
+        self._calMaxLoadedMonths = max(int(maxLoadedMonths), 5)  # the displayed month and the grids of the months before/after
+        self._wait__calShardPrefetch = Wait(0.5, self._PrefetchCalShards)
+        self._wait__calShardPrefetch.Cancel()
+        self._calRetainMonths = None if retainMonths is None else max(int(retainMonths), 1)
+        self._wait__calArchive = Wait(10, self._ArchiveCalEvents)
+        self._wait__calArchive.Cancel()
+        self._calArchiveCache = collections.OrderedDict([
+            # (shardKey, (events, eventsByDate, intervalIndex)), the archived months read most recently, see self._GetArchivedMonth()
+        ])
+        self._calArchiveIDShard = None  # {ID: shardKey} of the archived events, read the first time an ID is not found
+        self._calTransactionDepth = 0
+        self._calTransactionChanged = False
         self._calendarCurrentDatetimeChanges = None
         if startDay is None:
             startDay = 6  # sunday
@@ -389,17 +445,42 @@ class UserInputClass:
         self._currentYear = 0
         self._currentMonth = 0
         self._currentDatetime = datetime.datetime.now()
-        self._calEvents = [
-            # {'datetime': dt,
-            # 'name': 'name of event',
-            # 'meta': {'Room Name': 'Room1',
-            #          'Device Name': 'Room2',
-            #           }
-            # }
-        ]
+        self._calEvents = collections.OrderedDict([  # only the events in the loaded shards
+            # (ID, {'datetime': dt,
+            #       'name': 'name of event',
+            #       'meta': {'Room Name': 'Room1',
+            #                'Device Name': 'Room2',
+            #                },
+            #       'ID': ID,
+            #       }),
+        ])
+        self._calEventsByDate = {
+            # datetime.date: [eventDict1, eventDict2, ...]
+        }
+        self._calIntervalIndex = EventIntervalIndexClass()
+        self._calMetaIndex = MetaIndexClass(indexedMetaKeys or [])
+        self._calTextIndex = TextIndexClass()
+        self._calRecurringEvents = {
+            # ID: eventDict with a 'Recurrence' key
+        }
+        self._calMonthCache = MonthCacheClass()
+        self._calShards = {
+            # shardKey: collections.OrderedDict of ID -> eventDict, for each loaded shard
+        }
+        self._calIDShard = {
+            # ID: shardKey, for every event that has been seen, loaded or not
+        }
+        self._calWordShards = ShardWordIndexClass()  # the shards that have each word, see self._SearchUnloadedCalShards()
+        self._calShardsScanned = False  # True once the IDs and words of every shard have been read, see self._ScanCalShards()
+        self._calShardPrefetched = {
+            # shardKey: (version, events, needsCompaction), read in the background by self._PrefetchCalShards()
+        }
         self._calCallback = None
         self._dtMap = {}
+        self._btnDateMap = {}
         self._calHeldEvent = None
+        self._calChangeCount = 0  # changes every time an event is added/updated/deleted/archived
+        self._calEventsView = (None, ())  # (self._calChangeCount, tuple of all the eventDicts), see self.GetCalendarEventsView()
 
         # Hide/Cancel button
         if self._calBtnCancel is not None:
@@ -407,6 +488,7 @@ class UserInputClass:
             def calBtnCancelEvent(button, state):
                 if self._calPopupName is not None:
                     self._TLP.HidePopup(self._calPopupName)
+                    self._calShowing = False
 
         # Next/Prev buttons
         @event(self._calBtnNext, 'Released')
@@ -468,6 +550,7 @@ class UserInputClass:
     def GetDate(self, *a, **k):
         return self.get_date(*a, **k)
 
+    @CalendarLocked
     def get_date(self,
                  popupName=None,
                  callback=None,
@@ -514,6 +597,7 @@ class UserInputClass:
         # Show the calendar
         if popupName is not None:
             self._TLP.ShowPopup(popupName)
+        self._calShowing = True
 
         @event(self._calDayNumBtns, 'Released')
         @event(self._calDayAgendaBtns, 'Released')
@@ -523,6 +607,7 @@ class UserInputClass:
                 self._calCallback(self, dt)
                 self._currentDatetime = dt
 
+    @CalendarLocked
     def CalOffsetTimedelta(self, delta):
         '''
         Change the calendar by delta time.
@@ -547,9 +632,7 @@ class UserInputClass:
         return self._currentDatetime
 
     def _GetDatetimeFromButton(self, button):
-        for date in self._dtMap:
-            if button in self._dtMap[date]:
-                return date
+        return self._btnDateMap.get(button, None)
 
     def UpdateMonthDisplay(self, dt=None):
         '''
@@ -560,15 +643,15 @@ class UserInputClass:
         if dt is None:
             dt = self.GetCalCurrentDatetime()
 
-        for instance in self._instances:
-            instance._calDisplayMonth(dt)
+        # every instance is marked dirty and redrawn once on the next frame, hidden calendars are redrawn by get_date()
+        self._broadcaster.MarkDirty(dt)
 
-    def _GetWeekOfMonth(self, dt):
-        weeks = calendar.monthcalendar(dt.year, dt.month)
-        for index, week in enumerate(weeks):
-            if dt.day in week:
-                return index + 1
+    @CalendarLocked
+    def _calDisplayMonthIfShowing(self):
+        if self._calShowing:
+            self._calDisplayMonth()
 
+    @CalendarLocked
     def _calDisplayMonth(self, dt=None):
         # date = datetime.datetime object
         # this will update the TLP with data for the month of the datetime.date
@@ -576,9 +659,12 @@ class UserInputClass:
         if dt is None:
             dt = self._currentDatetime
 
+        self._broadcaster.Rendered(self)
+
         self._currentDatetime = dt
 
         self._dtMap = {}
+        self._btnDateMap = {}
 
         self._calLblMonthYear.SetText(dt.strftime('%B %Y'))
 
@@ -587,8 +673,8 @@ class UserInputClass:
         #     if btn.ID % 100 >= 35:
         #         btn.SetVisible(False)
 
-        monthDates = list(self._calObj.itermonthdates(dt.year, dt.month))
-        for index, date in enumerate(monthDates):
+        cells = self._GetMonthCells(dt)
+        for index, (date, newState, newText, agendaText, weekNum) in enumerate(cells):
             if index >= len(self._calDayNumBtns):
                 continue
 
@@ -597,14 +683,10 @@ class UserInputClass:
 
             # Save the datetime and map it to the buttons for later use
             self._dtMap[date] = [btnDayNum, btnDayAgenda]
+            self._btnDateMap[btnDayNum] = date
+            self._btnDateMap[btnDayAgenda] = date
 
-            if date.month != self._currentMonth:  # Not part of the month
-
-                newState = 1
-                newText = date.strftime('%d ')
-
-            else:  # is part of the current month
-                weekNum = self._GetWeekOfMonth(date)
+            if newState == 0:  # is part of the current month
                 if weekNum >= 6:
                     # This is part of this month and is in the 6th week, show it
                     if not btnDayNum.Visible:
@@ -612,11 +694,6 @@ class UserInputClass:
                     if not btnDayAgenda.Visible:
                         btnDayAgenda.SetVisible(True)
 
-                newState = 0
-                newText = date.strftime('%d ')
-
-            agendaText = self._GetAgendaText(date)
-
             # btnDayNum
             if btnDayNum.State != newState:
                 btnDayNum.SetState(newState)
@@ -631,37 +708,213 @@ class UserInputClass:
             if btnDayAgenda.Text != agendaText:
                 btnDayAgenda.SetText(agendaText)
 
+        # these buttons are past the current month, set to visible false
+        for index in range(len(cells), min(len(self._calDayNumBtns), 42)):
+            btnDayNum = self._calDayNumBtns[index]
+            btnDayAgenda = self._calDayAgendaBtns[index]
+
+            btnDayNum.SetVisible(False)
+            btnDayAgenda.SetVisible(False)
+
+        # read the months that Next/Prev will need in the background
+        self._wait__calShardPrefetch.Restart()
+        if self._calRetainMonths is not None:
+            self._wait__calArchive.Restart()
+
+    def _GetMonthCells(self, dt):
+        '''
+        Returns the render data for the 6-week grid of a month, one tuple per cell/button index.
+        Months that were already rendered come from self._calMonthCache.
+        :param dt: datetime.datetime
+        :return: list of tuples like (datetime.date, state, dayText, agendaText, weekNum)
+        '''
+        key = (dt.year, dt.month, self._maxAgendaWidth, self._calObj.firstweekday)
+
+        cells = self._calMonthCache.Get(key)
+        if cells is None:
+            self._EnsureCalShardsLoaded(self._GetCalDisplayShardKeys(dt))
+            generation = self._calMonthCache.GetGeneration()  # loading shards changes the generation too
+
+            monthDates = list(self._calObj.itermonthdates(dt.year, dt.month))
+            occurrencesByDate = self._GetOccurrencesByDate(monthDates[0], monthDates[-1] + datetime.timedelta(days=1))
+
+            cells = []
+            for index, date in enumerate(monthDates):
+                if date.month != dt.month:  # Not part of the month
+                    newState = 1
+                else:  # is part of the current month
+                    newState = 0
+
+                cells.append((
+                    date,
+                    newState,
+                    date.strftime('%d '),
+                    self._GetAgendaText(date, occurrencesByDate.get(date, [])),
+                    index // 7 + 1,  # week of the month
+                ))
+
+            # if the events changed while this was being built, the cells are returned but not cached
+            self._calMonthCache.Put(key, cells, monthDates[0], monthDates[-1], generation)
+
+        return cells
+
+    def _InvalidateCalEvent(self, eventDict):
+        # drop the cached months that show this event
+        if eventDict.get('Recurrence', None):
+            until = eventDict['Recurrence']['until']
+            self._calMonthCache.InvalidateRange(
+                GetDateKey(eventDict['datetime']),
+                GetDateKey(until) if until is not None else None,
+            )
         else:
-            # these buttons are past the current month, set to visible false
-            while index <= 41:
-                btnDayNum = self._calDayNumBtns[index]
-                btnDayAgenda = self._calDayAgendaBtns[index]
+            self._calMonthCache.InvalidateRange(GetDateKey(eventDict['datetime']), GetDateKey(eventDict['datetime']))
+
+    def _IndexCalEvent(self, eventDict):
+        # keep the per-date index in step with self._calEvents
+        shardEvents = self._calShards.get(CalendarStorageClass.GetShardKey(eventDict), None)
+        if shardEvents is None:
+            # a shard made here would only hold this event, and writing it would lose the rest of the month
+            raise Exception('Exception in _IndexCalEvent\nThe shard of event {} is not loaded'.format(eventDict['ID']))
+
+        self._InvalidateCalEvent(eventDict)
+        shardEvents[eventDict['ID']] = eventDict
+        self._calTextIndex.Add(eventDict)
+        self._calWordShards.Add(CalendarStorageClass.GetShardKey(eventDict), eventDict)
+
+        if eventDict.get('Recurrence', None):
+            # recurring events are expanded on demand, see self._GetOccurrences()
+            self._calRecurringEvents[eventDict['ID']] = eventDict
+            return
 
-                btnDayNum.SetVisible(False)
-                btnDayAgenda.SetVisible(False)
+        key = GetDateKey(eventDict['datetime'])
+        self._calEventsByDate.setdefault(key, []).append(eventDict)
+        self._calIntervalIndex.Add(eventDict)
+        self._calMetaIndex.Add(eventDict)
 
-                index += 1
+    def _UnindexCalEvent(self, eventDict):
+        self._InvalidateCalEvent(eventDict)
+        self._calShards.get(CalendarStorageClass.GetShardKey(eventDict), {}).pop(eventDict['ID'], None)
+        self._calTextIndex.Remove(eventDict)
 
-    def _GetAgendaText(self, date):
+        if eventDict.get('Recurrence', None):
+            self._calRecurringEvents.pop(eventDict['ID'], None)
+            return
+
+        key = GetDateKey(eventDict['datetime'])
+        dayEvents = self._calEventsByDate.get(key, [])
+        for index, item in enumerate(dayEvents):
+            if item is eventDict:
+                del dayEvents[index]
+                break
+
+        if not dayEvents:
+            self._calEventsByDate.pop(key, None)
+
+        self._calIntervalIndex.Remove(eventDict)
+        self._calMetaIndex.Remove(eventDict)
+
+    def _RebuildCalIndexes(self):
+        self._calEventsByDate = {}
+        self._calIntervalIndex = EventIntervalIndexClass()
+        self._calMetaIndex = MetaIndexClass(self._calMetaIndex.GetKeys())
+        self._calTextIndex = TextIndexClass()
+        self._calRecurringEvents = {}
+        self._calMonthCache.Clear()
+        self._calShards = {shardKey: collections.OrderedDict() for shardKey in self._calShards}
+        for item in self._calEvents.values():
+            self._IndexCalEvent(item)
+
+    def _GetOccurrences(self, startDT, endDT, overlap=False, masters=None):
+        '''
+        Expands the recurring events into occurrence eventDicts, only for the window startDT to endDT
+        :param startDT: datetime.datetime or datetime.date
+        :param endDT: datetime.datetime or datetime.date
+        :param overlap: bool - True returns occurrences that overlap the window, False returns occurrences that start in the window
+        :param masters: list of recurring eventDicts, None means all of them
+        :return: list of eventDicts sorted by start time
+        '''
+        if masters is None:
+            masters = self._calRecurringEvents.values()
+
+        startDT, endDT = GetDatetime(startDT), GetDatetime(endDT)
+
+        result = []
+        for master in masters:
+            start, end = EventIntervalIndexClass.GetSpan(master)
+            duration = end - start if overlap else None
+
+            for dt in IterRecurrenceStarts(start, master['Recurrence'], startDT, endDT, duration):
+                result.append(CalendarEventClass(
+                    dt,
+                    master['name'],
+                    master['meta'],
+                    dt + (end - start) if master.get('End Time', None) else None,
+                    '{}@{}'.format(master['ID'], dt.strftime('%Y%m%d')),
+                    seriesID=master['ID'],
+                ))
+
+        result.sort(key=lambda item: item['datetime'])
+        return result
+
+    def _GetOccurrencesByDate(self, startDate, endDate):
+        # returns a dict like {datetime.date: [occurrenceEventDict1, ...]}
+        result = {}
+        if self._calRecurringEvents:
+            for item in self._GetOccurrences(startDate, endDate):
+                result.setdefault(GetDateKey(item['datetime']), []).append(item)
+        return result
+
+    def _GetDayEvents(self, date, occurrences=None):
+        # returns the eventDicts that start on this date, including occurrences of recurring events
+        self._EnsureCalShardsLoaded([CalendarStorageClass.GetMonthShardKey(date)])
+        result = self._calEventsByDate.get(GetDateKey(date), [])
+
+        archived = self._GetArchivedDayEvents(date)
+        if archived:
+            result = sorted(result + archived, key=lambda item: item['datetime'])
+
+        if occurrences is None:
+            # the whole day, date may be a datetime.datetime part way through it
+            day = GetDateKey(date)
+            occurrences = self._GetOccurrencesByDate(day, day + datetime.timedelta(days=1)).get(day, [])
+
+        if occurrences:
+            result = sorted(result + occurrences, key=lambda item: item['datetime'])
+
+        return result
+
+    def _WithOccurrences(self, events, startDT, endDT, test=None):
+        # adds the occurrences that overlap startDT to endDT to a list of eventDicts from self._calIntervalIndex
+        if not self._calRecurringEvents:
+            return events
+
+        occurrences = self._GetOccurrences(startDT, endDT, overlap=True)
+        if test is not None:
+            occurrences = [item for item in occurrences if test(*EventIntervalIndexClass.GetSpan(item))]
+
+        if occurrences:
+            events = sorted(events + occurrences, key=lambda item: EventIntervalIndexClass.GetSpan(item)[0])
+
+        return events
+
+    def _GetAgendaText(self, date, occurrences=None):
         result = ''
 
-        for item in self._calEvents:
+        for item in self._GetDayEvents(date, occurrences):
             dt = item['datetime']
-            if date.year == dt.year:
-                if date.month == dt.month:
-                    if date.day == dt.day:
-                        name = item['name']
-                        string = '{} - {}\n'.format(dt.strftime('%I:%M%p'), name)
+            name = item['name']
+            string = '{} - {}\n'.format(dt.strftime('%I:%M%p'), name)
 
-                        # Make sure the string isnt too long
-                        if self._maxAgendaWidth is not None:
-                            if len(string) > self._maxAgendaWidth:
-                                string = string[:self._maxAgendaWidth - 4] + '...\n'
+            # Make sure the string isnt too long
+            if self._maxAgendaWidth is not None:
+                if len(string) > self._maxAgendaWidth:
+                    string = string[:self._maxAgendaWidth - 4] + '...\n'
 
-                        result += string
+            result += string
 
         return result
 
+    @CalendarLocked
     def GetAgendaFromDatetime(self, date):
         '''
         Returns a list of eventDicts that are happening on the date
@@ -677,23 +930,383 @@ class UserInputClass:
         :return: list like [{eventDict1, eventDict2, ...]
         '''
 
+        return list(self._GetDayEvents(date))
+
+    @CalendarLocked
+    def GetEventsOverlapping(self, startDT, endDT):
+        '''
+        Returns a list of eventDicts whose 'Start Time' to 'End Time' overlaps startDT to endDT.
+        For example, UserInput.GetEventsOverlapping(10:00, 11:30) answers "is anything happening from 10:00 to 11:30?"
+        :param startDT: datetime.datetime
+        :param endDT: datetime.datetime
+        :return: list of eventDicts sorted by start time
+        '''
+        self._EnsureCalRangeLoaded(startDT, endDT)
+        events = self._WithArchivedEvents(
+            self._calIntervalIndex.Overlapping(startDT, endDT),
+            self._GetCalRangeShardKeys(startDT, endDT),
+            lambda index: index.Overlapping(startDT, endDT),
+        )
+        return self._WithOccurrences(events, startDT, endDT)
+
+    @CalendarLocked
+    def GetEventsWithin(self, startDT, endDT):
+        '''
+        Returns a list of eventDicts that start and end within startDT to endDT
+        :param startDT: datetime.datetime
+        :param endDT: datetime.datetime
+        :return: list of eventDicts sorted by start time
+        '''
+        self._EnsureCalRangeLoaded(startDT, endDT)
+        events = self._WithArchivedEvents(
+            self._calIntervalIndex.Within(startDT, endDT),
+            CalendarStorageClass.GetMonthShardKeys(startDT, endDT),
+            lambda index: index.Within(startDT, endDT),
+        )
+        return self._WithOccurrences(
+            events,
+            startDT,
+            endDT,
+            test=lambda start, end: GetDatetime(startDT) <= start and end <= GetDatetime(endDT),
+        )
+
+    @CalendarLocked
+    def GetEventsAt(self, dt):
+        '''
+        Returns a list of eventDicts that are happening at the moment dt
+        :param dt: datetime.datetime
+        :return: list of eventDicts sorted by start time
+        '''
+        dt = GetDatetime(dt)
+        self._EnsureCalRangeLoaded(dt, dt)
+        events = self._WithArchivedEvents(
+            self._calIntervalIndex.At(dt),
+            self._GetCalRangeShardKeys(dt, dt),
+            lambda index: index.At(dt),
+        )
+        return self._WithOccurrences(
+            events,
+            dt,
+            dt + datetime.timedelta(microseconds=1),
+        )
+
+    @CalendarLocked
+    def GetEventsInRange(self, startDT, endDT):
+        '''
+        Returns a list of eventDicts that start from startDT up to, but not including, endDT
+        :param startDT: datetime.datetime or datetime.date
+        :param endDT: datetime.datetime or datetime.date
+        :return: list of eventDicts sorted by start time
+        '''
+        startDT, endDT = GetDatetime(startDT), GetDatetime(endDT)
+        self._EnsureCalShardsLoaded(CalendarStorageClass.GetMonthShardKeys(startDT, endDT))
+        return self._GetEventsStarting(startDT, endDT)
+
+    @CalendarLocked
+    def GetUpcomingEvents(self, after=None, n=10):
+        '''
+        Returns the next n events that start at or after the datetime after.
+        For example, room signage can show UserInput.GetUpcomingEvents(n=3)
+        :param after: datetime.datetime or datetime.date - None means now
+        :param n: int
+        :return: list of up to n eventDicts sorted by start time
+        '''
+        if after is None:
+            after = datetime.datetime.now()
+        after = GetDatetime(after)
+
+        # read forward one month at a time until there are n events, or there are no more months that could have any
+        monthStart = datetime.datetime(after.year, after.month, 1)
+        monthKeys = [shardKey for shardKey in self._calStorage.ListShards() if shardKey != CalendarStorageClass.RECURRING]
+        lastMonthKey = max(monthKeys + [CalendarStorageClass.GetMonthShardKey(monthStart)])
+        if self._calRecurringEvents:
+            lastMonthKey = max(lastMonthKey, CalendarStorageClass.GetMonthShardKey(AddMonths(monthStart, 12)))
+
         result = []
+        while len(result) < n and CalendarStorageClass.GetMonthShardKey(monthStart) <= lastMonthKey:
+            monthEnd = AddMonths(monthStart, 1)
+            self._EnsureCalShardsLoaded([CalendarStorageClass.GetMonthShardKey(monthStart)])
+            result.extend(self._GetEventsStarting(max(after, monthStart), monthEnd))
+            monthStart = monthEnd
+
+        return result[:n]
+
+    def _GetEventsStarting(self, startDT, endDT):
+        # the loaded/archived events and occurrences that start from startDT up to endDT, sorted by start time
+        events = self._WithArchivedEvents(
+            self._calIntervalIndex.StartingBetween(startDT, endDT),
+            CalendarStorageClass.GetMonthShardKeys(startDT, endDT),
+            lambda index: index.StartingBetween(startDT, endDT),
+        )
 
-        for item in self._calEvents:
-            dt = item['datetime']
-            if date.year == dt.year:
-                if date.month == dt.month:
-                    if date.day == dt.day:
-                        name = item['name']
-                        result.append(item)
+        if self._calRecurringEvents:
+            occurrences = self._GetOccurrences(startDT, endDT)
+            if occurrences:
+                events = sorted(events + occurrences, key=lambda item: EventIntervalIndexClass.GetSpan(item)[0])
+
+        return events
+
+    @CalendarLocked
+    def GetConflictingEvents(self, startDT, endDT=None, metaDict=None, conflictMetaKey=None, ignoreID=None):
+        '''
+        Returns a list of eventDicts that would conflict with a new event from startDT to endDT
+        :param startDT: datetime.datetime
+        :param endDT: datetime.datetime
+        :param metaDict: dict - the meta of the new event
+        :param conflictMetaKey: str - only events with the same metaDict[conflictMetaKey] conflict. For example 'Room Number'
+        :param ignoreID: str - an event with this ID is not a conflict, used when an event is being updated
+        :return: list of eventDicts sorted by start time
+        '''
+        if endDT is None:
+            endDT = startDT
+
+        if endDT == startDT:
+            candidates = self.GetEventsAt(startDT)
+        else:
+            candidates = self.GetEventsOverlapping(startDT, endDT)
+
+        result = []
+        for item in candidates:
+            if ignoreID is not None and item['ID'] == ignoreID:
+                continue
+
+            if conflictMetaKey is not None:
+                if (metaDict or {}).get(conflictMetaKey, None) != item['meta'].get(conflictMetaKey, None):
+                    continue
+
+            result.append(item)
+
+        return result
+
+    @CalendarLocked
+    def GetEventsByMeta(self, metaKey, value, startDT, endDT=None):
+        '''
+        Returns a list of eventDicts where eventDict['meta'][metaKey] == value and that overlap startDT to endDT.
+        For example, UserInput.GetEventsByMeta('Room Number', 'Room 101', datetime.date.today())
+        This is answered from an index when metaKey was passed to setup_calendar(indexedMetaKeys=[...])
+        :param metaKey: str
+        :param value: the meta value to match
+        :param startDT: datetime.datetime or datetime.date
+        :param endDT: datetime.datetime or datetime.date - None means the whole day of startDT
+        :return: list of eventDicts sorted by start time
+        '''
+        if endDT is None:
+            startDT = GetDateKey(startDT)
+            endDT = startDT + datetime.timedelta(days=1)
+
+        startDT, endDT = GetDatetime(startDT), GetDatetime(endDT)
+        self._EnsureCalRangeLoaded(startDT, endDT)
+
+        events = self._calMetaIndex.Overlapping(metaKey, value, startDT, endDT)
+        if events is None:
+            # this key is not indexed
+            events = [
+                item for item in self._calIntervalIndex.Overlapping(startDT, endDT)
+                if item['meta'].get(metaKey, None) == value
+            ]
+
+        events = self._WithArchivedEvents(
+            events,
+            self._GetCalRangeShardKeys(startDT, endDT),
+            lambda index: [item for item in index.Overlapping(startDT, endDT) if item['meta'].get(metaKey, None) == value],
+        )
+
+        masters = [item for item in self._calRecurringEvents.values() if item['meta'].get(metaKey, None) == value]
+        if masters:
+            occurrences = self._GetOccurrences(startDT, endDT, overlap=True, masters=masters)
+            events = sorted(events + occurrences, key=lambda item: EventIntervalIndexClass.GetSpan(item)[0])
+
+        return events
+
+    @CalendarLocked
+    def GetBusyIntervals(self, metaKey, values, startDT, endDT=None):
+        '''
+        Returns the times that each resource is busy, for example each room.
+        Overlapping and back-to-back events are merged into one interval.
+        :param metaKey: str - the meta key that names the resource, like 'Room Number'
+        :param values: list of meta values, like ['Room 101', 'Room 102']
+        :param startDT: datetime.datetime or datetime.date
+        :param endDT: datetime.datetime or datetime.date - None means the end of the day of startDT
+        :return: dict like {'Room 101': [(startDT, endDT), ...], 'Room 102': []} intervals are clipped to startDT/endDT
+        '''
+        startDT, endDT = self._GetSlotWindow(startDT, endDT)
+
+        result = collections.OrderedDict()
+        for value in values:
+            result[value] = self._GetBusySpans(self.GetEventsByMeta(metaKey, value, startDT, endDT), startDT, endDT)
+        return result
+
+    @CalendarLocked
+    def GetAvailableSlots(self, metaKey, values, duration, startDT, endDT=None, limit=None):
+        '''
+        Finds the earliest free slot of each resource.
+        For example "the next 30 minute slot in any of these rooms today":
+        UserInput.GetAvailableSlots('Room Number', ['Room 101', 'Room 102'], datetime.timedelta(minutes=30), datetime.datetime.now())
+        :param metaKey: str - the meta key that names the resource, like 'Room Number'
+        :param values: list of meta values, like ['Room 101', 'Room 102']
+        :param duration: datetime.timedelta
+        :param startDT: datetime.datetime or datetime.date - the earliest the slot can start
+        :param endDT: datetime.datetime or datetime.date - the latest the slot can end, None means the end of the day of startDT
+        :param limit: int - the max number of slots to return, None returns one slot for each resource that has one
+        :return: list of tuples like [('Room 102', slotStartDT, slotEndDT), ...] sorted by slotStartDT
+        '''
+        startDT, endDT = self._GetSlotWindow(startDT, endDT)
+
+        result = []
+        for value, busy in self.GetBusyIntervals(metaKey, values, startDT, endDT).items():
+            # the free gaps are before, between and after the busy intervals
+            freeStart = startDT
+            for busyStart, busyEnd in busy + [(endDT, endDT)]:
+                if busyStart - freeStart >= duration:
+                    result.append((value, freeStart, freeStart + duration))
+                    break
+                freeStart = max(freeStart, busyEnd)
+
+        result.sort(key=lambda item: item[1])
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+    @CalendarLocked
+    def GetNextAvailableSlot(self, metaKey, values, duration, startDT, endDT=None):
+        '''
+        Same as self.GetAvailableSlots() but only returns the earliest slot
+        :return: tuple like ('Room 102', slotStartDT, slotEndDT) or None if no resource is free for that long
+        '''
+        slots = self.GetAvailableSlots(metaKey, values, duration, startDT, endDT, limit=1)
+        return slots[0] if slots else None
+
+    @staticmethod
+    def _GetSlotWindow(startDT, endDT):
+        if endDT is None:
+            endDT = GetDateKey(startDT) + datetime.timedelta(days=1)
+        return GetDatetime(startDT), GetDatetime(endDT)
+
+    @staticmethod
+    def _GetBusySpans(events, startDT, endDT):
+        # merges the spans of events (sorted by start time) into a list like [(start, end), ...] clipped to startDT/endDT
+        result = []
+        for item in events:
+            start, end = EventIntervalIndexClass.GetSpan(item)
+            start, end = max(start, startDT), min(end, endDT)
+            if start >= end:
+                continue  # an event with no 'End Time' does not make a resource busy
+
+            if result and start <= result[-1][1]:
+                if end > result[-1][1]:
+                    result[-1] = (result[-1][0], end)
+            else:
+                result.append((start, end))
+
+        return result
+
+    @CalendarLocked
+    def SearchCalendarEvents(self, query, limit=10, date_range=None):
+        '''
+        Finds the events whose name or str meta values contain words starting with each word of query.
+        For example 'bud rev' matches 'Budget Review'. This is fast enough to call on every keystroke.
+        Without a date_range every month is searched, the archive is not.
+            The months that are not loaded are read (not loaded) only if they have all the words,
+            the closest to now first, until they can not have anything closer than the results so far.
+        :param query: str
+        :param limit: int - the max number of eventDicts to return, None returns all of them
+        :param date_range: tuple like (startDT, endDT) - only events that overlap this range
+        :return: list of eventDicts, the closest to now first.
+            Recurring events are returned as their occurrences in date_range, or their next occurrence.
+        '''
+        now = datetime.datetime.now()
+
+        if date_range is not None:
+            startDT, endDT = GetDatetime(date_range[0]), GetDatetime(date_range[1])
+            self._EnsureCalRangeLoaded(startDT, endDT)
+
+        result = []
+        for item in self._calTextIndex.Search(query):
+            if item.get('Recurrence', None):
+                if date_range is not None:
+                    result.extend(self._GetOccurrences(startDT, endDT, overlap=True, masters=[item]))
+                else:
+                    nextStart = next(IterRecurrenceStarts(
+                        item['datetime'],
+                        item['Recurrence'],
+                        now,
+                        AddMonths(now, 12) or now + datetime.timedelta(days=365),
+                        EventIntervalIndexClass.GetSpan(item)[1] - item['datetime'],
+                    ), None)
+                    if nextStart is not None:
+                        result.extend(self._GetOccurrences(nextStart, nextStart + datetime.timedelta(microseconds=1),
+                                                           masters=[item]))
+                continue
+
+            if date_range is not None:
+                start, end = EventIntervalIndexClass.GetSpan(item)
+                if not (start < endDT and (end > startDT or start == end >= startDT)):
+                    continue
+
+            result.append(item)
+
+        result.sort(key=lambda item: abs(item['datetime'] - now))
+        if date_range is None:
+            result = self._SearchUnloadedCalShards(query, result, limit, now)
+
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+    def _SearchUnloadedCalShards(self, query, result, limit, now):
+        # adds the matches from the months that are not loaded to result, which is sorted by distance from now
+        self._ScanCalShards()
+
+        onDisk = self._calStorage.ListShards()
+        shardKeys = [
+            shardKey for shardKey in self._calWordShards.Search(query)
+            if shardKey in onDisk and shardKey not in self._calShards and shardKey != CalendarStorageClass.RECURRING
+        ]
+
+        distances = {}
+        for shardKey in shardKeys:
+            # the closest that an event in this month can be to now
+            monthStart = datetime.datetime.strptime(shardKey, '%Y-%m')
+            monthEnd = AddMonths(monthStart, 1)
+            if monthStart <= now < monthEnd:
+                distances[shardKey] = datetime.timedelta(0)
+            else:
+                distances[shardKey] = min(abs(monthStart - now), abs(monthEnd - now))
+
+        for shardKey in sorted(shardKeys, key=lambda key: distances[key]):
+            if limit is not None and len(result) >= limit and abs(result[limit - 1]['datetime'] - now) <= distances[shardKey]:
+                break  # this month and the ones after it can not have a closer event
+
+            events, needsCompaction = self._calStorage.ReadShard(shardKey)
+            matches = [item for item in events.values() if TextIndexClass.Matches(item, query)]
+            if matches:
+                result = sorted(result + matches, key=lambda item: abs(item['datetime'] - now))
 
         return result
 
+    @CalendarLocked
     def GetCalEventByID(self, ID):
-        for event in self._calEvents.copy():
-            if event.get('ID', None) == ID:
-                return event
+        event = self._FindCalEvent(ID)
+        if event is None and isinstance(ID, str) and '@' in ID:
+            # this may be one occurrence of a recurring event, like 'seriesID@20260314'
+            seriesID, day = ID.rsplit('@', 1)
+            master = self._calRecurringEvents.get(seriesID, None)
+            if master is not None:
+                try:
+                    date = datetime.datetime.strptime(day, '%Y%m%d')
+                except ValueError:
+                    return None
+
+                for item in self._GetOccurrences(date, date + datetime.timedelta(days=1), masters=[master]):
+                    if item['ID'] == ID:
+                        return item
+
+        if event is None:
+            event = self._FindArchivedCalEvent(ID)
+
+        return event
 
+    @CalendarLocked
     def GetAllCalendarEvents(self):
         '''
         eventDict looks like:
@@ -704,8 +1317,61 @@ class UserInputClass:
         }
         :return: list of all eventDicts
         '''
-        return self._calEvents.copy()
+        return list(self.GetCalendarEventsView())
 
+    @CalendarLocked
+    def GetCalendarEventsView(self):
+        '''
+        Returns a read-only snapshot of all the events, not including the archive.
+        While every month is loaded the same snapshot is returned until an event changes,
+            so this can be polled without copying the events each time.
+        Changes made after this returns do not affect the snapshot, so it is safe to loop over while events change.
+        :return: tuple of eventDicts (read-only CalendarEventClass)
+        '''
+        changeCount, view = self._calEventsView
+        if changeCount != self._calChangeCount:
+            changeCount = self._calChangeCount
+
+            # the months that are not loaded are read without loading them, so maxLoadedMonths still holds
+            view = []
+            allLoaded = True
+            for shardKey in sorted(set(self._calStorage.ListShards()) | set(self._calShards)):
+                shardEvents = self._calShards.get(shardKey, None)
+                if shardEvents is None:
+                    shardEvents, needsCompaction = self._calStorage.ReadShard(shardKey)
+                    allLoaded = False
+                view.extend(shardEvents.values())
+
+            view = tuple(view)
+            if allLoaded:
+                self._calEventsView = (changeCount, view)
+            else:
+                # keeping it would keep every month in memory
+                self._calEventsView = (None, ())
+
+        return view
+
+    @CalendarLocked
+    def IterCalendarEvents(self, startDT=None, endDT=None, test=None):
+        '''
+        Lazily yields the events that match, without building a list of all the events.
+        Example: for eventDict in UserInput.IterCalendarEvents(test=lambda e: e['meta'].get('Room Number') == 'Room 101')
+        :param startDT: datetime.datetime or datetime.date - only events that overlap startDT to endDT
+        :param endDT: datetime.datetime or datetime.date - None means the end of the day of startDT
+        :param test: function that accepts an eventDict and returns True to yield it
+        :return: generator of read-only eventDicts
+        '''
+        if startDT is None:
+            events = self.GetCalendarEventsView()
+        else:
+            if endDT is None:
+                endDT = GetDateKey(startDT) + datetime.timedelta(days=1)
+            events = self.GetEventsOverlapping(GetDatetime(startDT), GetDatetime(endDT))
+
+        # the snapshot is taken now, not when the caller starts looping
+        return (item for item in events if test is None or test(item))
+
+    @CalendarLocked
     def AddCalendarEvent(self,
                          startDT=None,
                          name=None,
@@ -714,6 +1380,11 @@ class UserInputClass:
                          ID=None,
                          _delayUpdate=True,
                          # weather to update the display immediately or wait for 1 second after last update
+                         conflicts=None,
+                         # None=dont check, 'report'=add the event and return the conflicts, 'reject'=only add the event if there are no conflicts
+                         conflictMetaKey=None,  # only events with the same metaDict[conflictMetaKey] conflict. For example 'Room Number'
+                         recurrence=None,
+                         # dict like {'freq': 'weekly', 'interval': 1, 'count': 10, 'until': datetime, 'exdates': [datetime.date]}
                          ):
         '''
         Add an event to the calendar
@@ -723,85 +1394,544 @@ class UserInputClass:
         :param metaDict: {}
         :param ID: str
         :param _delayUpdate: bool
-        :return:
+        :param conflicts: None, 'report' or 'reject'
+        :param conflictMetaKey: str
+        :param recurrence: dict - 'freq' is 'daily', 'weekly' or 'monthly', the other keys are optional.
+            The event is saved once and its occurrences are generated when they are displayed/requested.
+        :return: None, or if conflicts is not None, the list of conflicting eventDicts
+        '''
+        isNew = ID is None
+        newEvent = self._NewCalEvent(startDT, name, metaDict, endDT, ID, recurrence)
+
+        result = None
+        if conflicts is not None:
+            result = self.GetConflictingEvents(
+                startDT,
+                endDT,
+                newEvent['meta'],
+                conflictMetaKey=conflictMetaKey,
+                ignoreID=newEvent['ID'],
+            )
+            if result and conflicts == 'reject':
+                return result
+
+        if self._UpsertCalEvent(newEvent, isNew) != 'unchanged':
+            self._CalEventsChanged(startDT, _delayUpdate)
+
+        return result
+
+    @CalendarLocked
+    def AddCalendarEvents(self, eventDicts, deleteIDs=None, delayUpdate=True):
+        '''
+        Add/update many events with a single file write and a single redraw
+        :param eventDicts: iterable of eventDicts, like the ones returned by GetAllCalendarEvents()
+        :param deleteIDs: iterable of event IDs to delete in the same transaction
+        :param delayUpdate: bool
+        :return: dict like {'added': 2, 'updated': 1, 'unchanged': 5, 'deleted': 0}
+        '''
+        counts = {'added': 0, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+
+        with self.CalendarTransaction(delayUpdate):
+            for eventDict in eventDicts:
+                startDT = eventDict.get('Start Time', None) or eventDict['datetime']
+                newEvent = self._NewCalEvent(
+                    startDT,
+                    eventDict.get('name', None),
+                    eventDict.get('meta', None),
+                    eventDict.get('End Time', None),
+                    eventDict.get('ID', None),
+                    eventDict.get('Recurrence', None),
+                )
+
+                result = self._UpsertCalEvent(newEvent)
+                counts[result] += 1
+                if result != 'unchanged':
+                    self._CalEventsChanged(startDT)
+
+            for ID in deleteIDs or []:
+                if self._RemoveCalEvent(ID) is not None:
+                    counts['deleted'] += 1
+                    self._CalEventsChanged()
+
+        return counts
+
+    @contextlib.contextmanager
+    def CalendarTransaction(self, delayUpdate=True):
         '''
-        if metaDict is None:
-            metaDict = {}
+        Apply many calendar changes as one file write and a single redraw.
+        Example:
+        with UserInput.CalendarTransaction():
+            UserInput.AddCalendarEvent(...)
+            UserInput.DeleteEventByID(...)
 
+        :param delayUpdate: bool - weather to update the display immediately or wait for 1 second
+        :return:
+        '''
+        with self._calLock:  # held until the transaction ends
+            self._calTransactionDepth += 1
+            if self._calTransactionDepth == 1:
+                self._calTransactionChanged = False
+
+            try:
+                yield self
+            finally:
+                self._calTransactionDepth -= 1
+                if self._calTransactionDepth == 0:
+                    self._EvictCalShards(keep=[])
+
+                    if self._calTransactionChanged:
+                        self._wait__calWrite.Restart()
+                        if delayUpdate:
+                            self._wait__calDisplayMonth.Restart()
+                        elif self._calShowing:
+                            self._calDisplayMonth()
+
+    def _NewCalEvent(self, startDT, name, metaDict=None, endDT=None, ID=None, recurrence=None):
         if ID is None:
-            ID = GetRandomHash()
-
-        newEvent = {
-            'datetime': startDT,
-            'name': name,
-            'meta': metaDict,
-            'Start Time': startDT,
-            'End Time': endDT,
-            'ID': ID,  # assign a unique str to each event
-        }
+            ID = GetRandomHash()  # assign a unique str to each event
+
+        if recurrence:
+            recurrence = GetRecurrenceDict(recurrence)
+
+        return CalendarEventClass(startDT, name, metaDict, endDT, ID, recurrence)
+
+    def _UpsertCalEvent(self, newEvent, isNew=False):
+        # returns 'added', 'updated' or 'unchanged'
+        # isNew=True skips looking for an older copy, for IDs that were just generated
+        ID = newEvent['ID']
+        shardKey = CalendarStorageClass.GetShardKey(newEvent)
+        result = 'added'
+
+        # an event that can not be saved raises here, before any of the indexes are changed
+        record = self._calStorage.MakePutRecord(newEvent)
+
+        oldShardKey = None if isNew else self._GetCalShardOfID(ID)
+        if oldShardKey is None and not isNew:
+            archivedEvent = self._FindArchivedCalEvent(ID)
+            if archivedEvent is not None:
+                if archivedEvent == newEvent:
+                    return 'unchanged'
+                # the updated event is saved with the events that are not archived, the next archive pass moves it back
+                self._RemoveArchivedCalEvent(ID)
+                result = 'updated'
+
+        self._EnsureCalShardsLoaded([shardKey] if oldShardKey is None else [shardKey, oldShardKey])
+
+        oldEvent = self._calEvents.get(ID, None)
+        if oldEvent is not None:
+            if oldEvent == newEvent:
+                return 'unchanged'  # ignore this duplicate
+            else:
+                # this event is being updated
+                self._UnindexCalEvent(self._calEvents.pop(ID))
+                result = 'updated'
+
+                if CalendarStorageClass.GetShardKey(oldEvent) != shardKey:
+                    self._JournalCalDelete(oldEvent)  # the event moved to another month
+
+        self._calEvents[ID] = newEvent
+        self._calIDShard[ID] = shardKey
+        self._IndexCalEvent(newEvent)
+        self._JournalCalEvent(newEvent, record)
+        self._calChangeCount += 1
+        return result
 
-        for event in self._calEvents.copy():
-            if event['ID'] == newEvent['ID']:
-                if event == newEvent:
-                    break  # ignore this duplicate
-                else:
-                    # this event is being updated
-                    self._calEvents.remove(event)
-        else:
-            # add the event normally
-            self._calEvents.append(newEvent)
+    def _RemoveCalEvent(self, ID):
+        # returns the removed eventDict or None
+        event = self._FindCalEvent(ID)
+        if event is not None:
+            del self._calEvents[ID]
+            self._calIDShard.pop(ID, None)
+            self._UnindexCalEvent(event)
+            self._JournalCalDelete(event)
+            self._calChangeCount += 1
+        return event
+
+    def _FindCalEvent(self, ID):
+        # returns the stored eventDict with this ID, loading its shard if needed
+        event = self._calEvents.get(ID, None)
+        if event is None:
+            shardKey = self._GetCalShardOfID(ID)
+            if shardKey is not None:
+                self._EnsureCalShardsLoaded([shardKey])
+                event = self._calEvents.get(ID, None)
+        return event
+
+    def _GetCalShardOfID(self, ID):
+        event = self._calEvents.get(ID, None)
+        if event is not None:
+            return CalendarStorageClass.GetShardKey(event)
+
+        if ID not in self._calIDShard:
+            self._ScanCalShards()
+
+        return self._calIDShard.get(ID, None)
+
+    def _ScanCalShards(self):
+        # reads the IDs and words of every shard once, after that they are tracked as events are added
+        if self._calShardsScanned:
+            return
+
+        for shardKey in self._calStorage.ListShards():
+            if shardKey not in self._calShards:
+                events, needsCompaction = self._calStorage.ReadShard(shardKey)
+                for eventID, eventDict in events.items():
+                    self._calIDShard.setdefault(eventID, shardKey)
+                    self._calWordShards.Add(shardKey, eventDict)
+
+        self._calShardsScanned = True
+
+    def _GetCalDisplayShardKeys(self, dt):
+        # the 6-week grid of a month also shows days of the month before and after
+        return CalendarStorageClass.GetMonthShardKeys(
+            AddMonths(datetime.datetime(dt.year, dt.month, 1), -1),
+            AddMonths(datetime.datetime(dt.year, dt.month, 1), 1),
+        )
+
+    def _GetCalRangeShardKeys(self, startDT, endDT):
+        # an event that starts in the month before startDT may still be running
+        return CalendarStorageClass.GetMonthShardKeys(
+            AddMonths(datetime.datetime(startDT.year, startDT.month, 1), -1),
+            endDT,
+        )
+
+    def _EnsureCalRangeLoaded(self, startDT, endDT):
+        self._EnsureCalShardsLoaded(self._GetCalRangeShardKeys(startDT, endDT))
 
-            self._SaveCalData()
-            self._currentDatetime = startDT
+    def _EnsureCalShardsLoaded(self, shardKeys):
+        '''
+        Loads the shards that are not already in memory, then unloads the months furthest from the displayed month
+            if there are more than self._calMaxLoadedMonths loaded
+        :param shardKeys: iterable of str
+        :return:
+        '''
+        shardKeys = list(shardKeys)
+        missing = [shardKey for shardKey in shardKeys if shardKey not in self._calShards]
+        if not missing:
+            return
 
-            if _delayUpdate:
-                self._wait__calDisplayMonth.Restart()
+        onDisk = self._calStorage.ListShards()
+        for shardKey in missing:
+            self._calShards[shardKey] = collections.OrderedDict()
+            if shardKey not in onDisk:
+                continue
+
+            prefetched = self._calShardPrefetched.pop(shardKey, None)
+            if prefetched is not None and prefetched[0] == self._calStorage.GetVersion(shardKey):
+                version, events, needsCompaction = prefetched
             else:
-                self._calDisplayMonth()
+                events, needsCompaction = self._calStorage.ReadShard(shardKey)
 
-    def _SaveCalData(self):
-        # Write the data to a file
-        saveItems = []
+            for ID, eventDict in events.items():
+                if ID not in self._calEvents:
+                    self._calEvents[ID] = eventDict
+                    self._calIDShard[ID] = shardKey
+                    self._IndexCalEvent(eventDict)
 
-        for item in self._calEvents:
-            dt = item['datetime']
-            saveItem = {
-                'datetime': GetDatetimeKwargs(dt),
-                'name': item['name'],
-                'meta': item['meta'],
-                'Start Time': GetDatetimeKwargs(item.get('Start Time', None)),
-                'End Time': GetDatetimeKwargs(item.get('End Time', None)),
-                'ID': item.get('ID', None),
-            }
-            saveItems.append(saveItem)
+            if needsCompaction:
+                # fold the journal into the snapshot so new records are never appended after a torn one,
+                #   this also converts a snapshot in the other file format
+                self._calStorage.QueueSnapshot(shardKey, self._calShards[shardKey].values())
+                self._wait__calWrite.Restart()
 
-        with File('calendar.json', mode='wt') as file:
-            file.write(json.dumps(saveItems, indent=4))
-            file.close()
+        self._EvictCalShards(keep=shardKeys)
 
-    def _LoadCalData(self):
-        if not File.Exists('calendar.json'):
-            self._calEvents = []
+    def _EvictCalShards(self, keep):
+        if self._calTransactionDepth:
+            return  # the transaction may still have records for any loaded shard, this is done when it ends
+
+        monthKeys = [shardKey for shardKey in self._calShards if shardKey != CalendarStorageClass.RECURRING]
+        if len(monthKeys) <= self._calMaxLoadedMonths:
             return
 
-        with File('calendar.json', mode='rt') as file:
-            saveItems = json.loads(file.read())
-            file.close()
+        # keep the months that the displayed grid and the prefetched Next/Prev grids show
+        firstOfMonth = datetime.datetime(self._currentDatetime.year, self._currentDatetime.month, 1)
+        keep = set(keep) | set(CalendarStorageClass.GetMonthShardKeys(AddMonths(firstOfMonth, -2), AddMonths(firstOfMonth, 2)))
+        currentMonth = CalendarStorageClass.GetMonthNumber(CalendarStorageClass.GetMonthShardKey(self._currentDatetime))
 
-            for saveItem in saveItems:
-                dt = datetime.datetime(**saveItem['datetime'])
+        # unload the months furthest from the displayed month first
+        candidates = sorted(
+            [shardKey for shardKey in monthKeys if shardKey not in keep],
+            key=lambda shardKey: abs(CalendarStorageClass.GetMonthNumber(shardKey) - currentMonth),
+            reverse=True,
+        )
+        for shardKey in candidates[:len(monthKeys) - self._calMaxLoadedMonths]:
+            shardEvents = self._calShards[shardKey]
+            if shardKey in self._calStorage.GetJournaledShards():
+                self._calStorage.QueueSnapshot(shardKey, shardEvents.values())
+                self._wait__calWrite.Restart()
+
+            for ID, eventDict in list(shardEvents.items()):
+                self._calEvents.pop(ID, None)
+                self._UnindexCalEvent(eventDict)
+
+            del self._calShards[shardKey]
+
+    def _PrefetchCalShards(self):
+        # Runs in the background after a month is displayed.
+        # Reads the shards that the next Next/Prev tap will need, they are indexed when they are first used.
+        # The files are read without holding self._calLock, so the buttons are not held up by the reads.
+        with self._calLock:
+            firstOfMonth = datetime.datetime(self._currentDatetime.year, self._currentDatetime.month, 1)
+            wanted = CalendarStorageClass.GetMonthShardKeys(AddMonths(firstOfMonth, -2), AddMonths(firstOfMonth, 2))
+
+            for shardKey in list(self._calShardPrefetched):
+                if shardKey not in wanted:
+                    self._calShardPrefetched.pop(shardKey, None)
+
+            onDisk = self._calStorage.ListShards()
+            shardKeys = [
+                shardKey for shardKey in wanted
+                if shardKey in onDisk and shardKey not in self._calShards and shardKey not in self._calShardPrefetched
+            ]
+
+        for shardKey in shardKeys:
+            version = self._calStorage.GetVersion(shardKey)  # a shard written after this is read again when it is used
+            try:
+                events, needsCompaction = self._calStorage.ReadShard(shardKey)
+            except Exception as e:
+                print('_PrefetchCalShards Exception:', e)
+                continue
+
+            with self._calLock:
+                self._calShardPrefetched[shardKey] = (version, events, needsCompaction)
+
+        self._PrefetchCalMonths()
+
+    @CalendarLocked
+    def _PrefetchCalMonths(self):
+        # Builds the grids of the months before and after the displayed month into self._calMonthCache,
+        #   so a Next/Prev tap only has to push text to the buttons.
+        firstOfMonth = datetime.datetime(self._currentDatetime.year, self._currentDatetime.month, 1)
+        for dt in [AddMonths(firstOfMonth, 1), AddMonths(firstOfMonth, -1)]:
+            try:
+                self._GetMonthCells(dt)
+            except Exception as e:
+                # the month will be built when it is displayed
+                print('_PrefetchCalMonths Exception:', e)
+
+    def _GetArchivedMonth(self, shardKey):
+        # returns (events, eventsByDate, intervalIndex) of one archived month, the archive is never loaded into self._calEvents
+        entry = self._calArchiveCache.pop(shardKey, None)
+        if entry is None:
+            events = collections.OrderedDict()
+            eventsByDate = {}
+            intervalIndex = EventIntervalIndexClass()
+            if shardKey in self._calStorage.ListArchivedShards():
+                events = self._calStorage.ReadArchivedShard(shardKey)
+                for eventDict in events.values():
+                    eventsByDate.setdefault(GetDateKey(eventDict['datetime']), []).append(eventDict)
+                    intervalIndex.Add(eventDict)
+
+                for dayEvents in eventsByDate.values():
+                    dayEvents.sort(key=lambda item: item['datetime'])
+
+            entry = (events, eventsByDate, intervalIndex)
+
+        self._calArchiveCache[shardKey] = entry  # most recently used is last
+        while len(self._calArchiveCache) > 3:
+            self._calArchiveCache.popitem(last=False)
+
+        return entry
+
+    def _GetArchivedDayEvents(self, date):
+        # returns the archived eventDicts that start on this date
+        shardKey = CalendarStorageClass.GetMonthShardKey(date)
+        if shardKey not in self._calStorage.ListArchivedShards():
+            return []
+
+        events, eventsByDate, intervalIndex = self._GetArchivedMonth(shardKey)
+        return eventsByDate.get(GetDateKey(date), [])
+
+    def _WithArchivedEvents(self, events, shardKeys, query):
+        # adds query(intervalIndex) of the archived months in shardKeys to a list of eventDicts
+        archivedShardKeys = self._calStorage.ListArchivedShards()
+
+        archived = []
+        for shardKey in shardKeys:
+            if shardKey in archivedShardKeys:
+                archived.extend(query(self._GetArchivedMonth(shardKey)[2]))
+
+        if archived:
+            events = sorted(events + archived, key=lambda item: EventIntervalIndexClass.GetSpan(item)[0])
+
+        return events
+
+    def _GetArchivedShardOfID(self, ID):
+        if not self._calStorage.ListArchivedShards():
+            return None
+
+        if self._calArchiveIDShard is None:
+            # read the IDs of the archive once, after that they are tracked as months are archived
+            self._calArchiveIDShard = {}
+            for shardKey in sorted(self._calStorage.ListArchivedShards()):
+                for eventID in self._calStorage.ReadArchivedShard(shardKey):
+                    self._calArchiveIDShard[eventID] = shardKey
+
+        return self._calArchiveIDShard.get(ID, None)
+
+    def _FindArchivedCalEvent(self, ID):
+        # returns the archived eventDict with this ID or None
+        shardKey = self._GetArchivedShardOfID(ID)
+        if shardKey is None:
+            return None
+        return self._GetArchivedMonth(shardKey)[0].get(ID, None)
+
+    def _RemoveArchivedCalEvent(self, ID):
+        # returns the removed archived eventDict or None
+        event = self._FindArchivedCalEvent(ID)
+        if event is not None:
+            shardKey = self._calArchiveIDShard.pop(ID)
+            self._calStorage.QueueArchiveDelete(shardKey, [ID])
+            self._calArchiveCache.pop(shardKey, None)
+            self._InvalidateCalEvent(event)
+            self._calChangeCount += 1
+            self._AfterCalJournal(shardKey)
+        return event
+
+    @CalendarLocked
+    def _ArchiveCalEvents(self):
+        '''
+        Runs in the background, holding self._calLock like the button events do.
+        Moves the months that are older than self._calRetainMonths out of the calendar and into the compressed archive.
+        Recurring events are never archived.
+        :return:
+        '''
+        if self._calRetainMonths is None or self._calTransactionDepth:
+            return
+
+        firstOfMonth = datetime.datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        oldestKept = CalendarStorageClass.GetMonthShardKey(AddMonths(firstOfMonth, -self._calRetainMonths))
+
+        for shardKey in sorted(self._calStorage.ListShards()):
+            if shardKey == CalendarStorageClass.RECURRING or shardKey >= oldestKept:
+                continue
+
+            if shardKey in self._calShards:
+                shardEvents = self._calShards.pop(shardKey)
+                for ID, eventDict in list(shardEvents.items()):
+                    self._calEvents.pop(ID, None)
+                    self._calIDShard.pop(ID, None)
+                    self._UnindexCalEvent(eventDict)
+                events = shardEvents.values()
+            else:
+                events, needsCompaction = self._calStorage.ReadShard(shardKey)
+                for ID in events:
+                    self._calIDShard.pop(ID, None)
+                events = events.values()
+
+            print('_ArchiveCalEvents archiving', shardKey)
+            events = list(events)
+            self._calStorage.QueueArchive(shardKey, events)
+            if self._calArchiveIDShard is not None:
+                for eventDict in events:
+                    self._calArchiveIDShard[eventDict['ID']] = shardKey
+            self._wait__calWrite.Restart()
+            self._calChangeCount += 1
+            self._calArchiveCache.pop(shardKey, None)
+            self._calShardPrefetched.pop(shardKey, None)
+
+    def _CalEventsChanged(self, dt=None, delayUpdate=True):
+        # redraw after the events have changed, transactions redraw once when they are done
+        if dt is not None:
+            self._currentDatetime = dt
+
+        if self._calTransactionDepth:
+            self._calTransactionChanged = True
+        elif delayUpdate:
+            self._wait__calDisplayMonth.Restart()
+        elif self._calShowing:
+            self._calDisplayMonth()
+
+    def FlushCalendar(self):
+        '''
+        Writes any calendar changes that are waiting for the background writer.
+        Call this before the program shuts down/reboots.
+        Raises an exception if something could not be written, the changes stay queued for the next write.
+        :return:
+        '''
+        self._wait__calWrite.Cancel()
+        with self._calLock:
+            self._QueueFullCalJournals()
+        if self._calStorage.HasPendingRecords():
+            self._calStorage.Flush()
+
+    def _WriteCalData(self):
+        # The background writer, runs a moment after the last change. Transactions are written when they end.
+        # Only the queueing holds self._calLock, the buttons are not held up while the files are written.
+        with self._calLock:
+            if self._calTransactionDepth:
+                return
+
+            self._QueueFullCalJournals()
+
+        try:
+            self._calStorage.Flush()
+        except Exception as e:
+            # the changes that were not written are still queued
+            print('_WriteCalData Exception:', e)
+            self._wait__calWrite.Restart()
+            return
+
+        self._wait__calCompact.Restart()
 
-                loadItem = {
-                    'datetime': dt,
-                    'name': saveItem['name'],
-                    'meta': saveItem['meta'],
-                    'Start Time': datetime.datetime(**saveItem.get('Start Time', None)),
-                    'End Time': datetime.datetime(**saveItem.get('End Time', None)),
-                    'ID': saveItem.get('ID', None)
-                }
+    def _QueueFullCalJournals(self):
+        # rewrite the snapshot of a loaded shard instead of growing its journal past maxJournalRecords
+        for shardKey in self._calStorage.GetFullJournals():
+            if shardKey in self._calShards:
+                self._calStorage.QueueSnapshot(shardKey, self._calShards[shardKey].values())
 
-                self._calEvents.append(loadItem)
+    @CalendarLocked
+    def _SaveCalData(self):
+        # Fold the journals into their snapshot files, the background writer does the writing
+        self._wait__calCompact.Cancel()
+        for shardKey in self._calStorage.GetJournaledShards():
+            self._QueueCalSnapshot(shardKey)
+
+        self._wait__calWrite.Restart()
+
+    def _QueueCalSnapshot(self, shardKey):
+        if shardKey not in self._calShards:
+            self._EnsureCalShardsLoaded([shardKey])  # never rewrite a shard from a partial view of it
+
+        self._calStorage.QueueSnapshot(shardKey, self._calShards[shardKey].values())
+
+    def _JournalCalEvent(self, eventDict, record=None):
+        self._calStorage.RecordPut(eventDict, record)
+        self._AfterCalJournal(CalendarStorageClass.GetShardKey(eventDict))
+
+    def _JournalCalDelete(self, eventDict):
+        self._calStorage.RecordDelete(eventDict)
+        self._AfterCalJournal(CalendarStorageClass.GetShardKey(eventDict))
+
+    def _AfterCalJournal(self, shardKey):
+        # the record is written by the background writer, it compacts the journal when it gets too long
+        if self._calTransactionDepth:
+            return  # the transaction writes everything at once when it is done
+
+        self._wait__calWrite.Restart()
 
+    @CalendarLocked
+    def _LoadCalData(self):
+        # only the recurring events and the months around today are loaded now, other months load when they are needed
+        self._calStorage.MigrateLegacy()
+
+        self._calEvents = collections.OrderedDict()
+        self._calIDShard = {}
+        self._calWordShards = ShardWordIndexClass()
+        self._calShardsScanned = False
+        self._calArchiveIDShard = None
+        self._calArchiveCache.clear()
+        self._RebuildCalIndexes()
+
+        self._EnsureCalShardsLoaded(
+            [CalendarStorageClass.RECURRING] + self._GetCalDisplayShardKeys(self._currentDatetime)
+        )
+
+        if self._calRetainMonths is not None:
+            self._wait__calArchive.Restart()
+
+    @CalendarLocked
     def GetCalEvents(self, dt=None, ID=None):
         '''
         return list of eventDicts happening at a specific datetime.datetime
@@ -817,28 +1947,25 @@ class UserInputClass:
         '''
         result = []
         if dt is not None:
-            for item in self._calEvents:
+            for item in self._GetDayEvents(dt):
                 dataDT = item['datetime']
-                if dt.year == dataDT.year:
-                    if dt.month == dataDT.month:
-                        if dt.day == dataDT.day:
-                            if isinstance(dt, datetime.datetime):
-                                if dt.hour != 0:
-                                    if dt.hour == dataDT.hour:
-                                        if dt.minute != 0:
-                                            if dt.minute == dataDT.minute:
-                                                result.append(item)
-                                        else:
-                                            result.append(item)
-                                else:
+                if isinstance(dt, datetime.datetime):
+                    if dt.hour != 0:
+                        if dt.hour == dataDT.hour:
+                            if dt.minute != 0:
+                                if dt.minute == dataDT.minute:
                                     result.append(item)
-                            else:  # probably a datetime.date object
+                            else:
                                 result.append(item)
+                    else:
+                        result.append(item)
+                else:  # probably a datetime.date object
+                    result.append(item)
 
         elif ID is not None:
-            for item in self._calEvents:
-                if item.get('ID', None) == ID:
-                    result.append(item)
+            item = self.GetCalEventByID(ID)
+            if item is not None:
+                result.append(item)
 
         return result
 
@@ -857,6 +1984,20 @@ class UserInputClass:
         '''
         return self._calHeldEvent.copy() if self._calHeldEvent else None
 
+    def GetHeldEventView(self):
+        '''
+        Returns the held eventDict without copying it.
+        :return: read-only eventDict or None
+        '''
+        if not self._calHeldEvent:
+            return None
+
+        if isinstance(self._calHeldEvent, CalendarEventClass):
+            return self._calHeldEvent  # already read-only
+
+        return types.MappingProxyType(self._calHeldEvent)
+
+    @CalendarLocked
     def TrashHeldEvent(self):
         '''
         Deletes the held event from memory.
@@ -865,14 +2006,42 @@ class UserInputClass:
         self.DeleteEvent(self._calHeldEvent)
         self._calHeldEvent = None
 
+    @CalendarLocked
     def DeleteEventByID(self, ID):
         print('862 DeleteEventByID(', ID)
-        for event in self._calEvents.copy():
-            if event.get('ID') == ID:
-                print('860 removing event=', event)
-                self._calEvents.remove(event)
-                self._wait__calDisplayMonth.Restart()
+        event = self._RemoveCalEvent(ID)
+        if event is None:
+            event = self._RemoveArchivedCalEvent(ID)
+
+        if event is None:
+            event = self.GetCalEventByID(ID)
+            if event is not None and self._ExcludeOccurrence(event):
+                self._CalEventsChanged()
+
+        else:
+            print('860 removing event=', event)
+            self._CalEventsChanged()
 
+    def _ExcludeOccurrence(self, occurrence):
+        # deleting one occurrence of a recurring event adds its date to the exdates of the series
+        master = self._calEvents.get(occurrence.get('Series ID', None), None)
+        if master is None:
+            return False
+
+        recurrence = dict(master['Recurrence'])
+        recurrence['exdates'] = recurrence['exdates'] + [GetDateKey(occurrence['datetime'])]
+
+        newMaster = self._NewCalEvent(
+            master['datetime'],
+            master['name'],
+            master['meta'],
+            master['End Time'],
+            master['ID'],
+            recurrence,
+        )
+        return self._UpsertCalEvent(newMaster) != 'unchanged'
+
+    @CalendarLocked
     def DeleteEvent(self, eventDict):
         '''
         Deletes the specified eventDict
@@ -880,13 +2049,20 @@ class UserInputClass:
         :return:
         '''
         print('DeleteEvent(', eventDict)
-        if eventDict in self._calEvents:
-            self._calEvents.remove(eventDict)
+        ID = eventDict.get('ID', None) if eventDict else None
+        if ID is not None and self._FindCalEvent(ID) == eventDict:
+            self._RemoveCalEvent(ID)
+        elif ID is not None and self._FindArchivedCalEvent(ID) == eventDict:
+            self._RemoveArchivedCalEvent(ID)
+        elif eventDict and eventDict.get('Series ID', None) in self._calEvents:
+            self._ExcludeOccurrence(eventDict)
         else:
             raise Exception('Exception in DeleteEvent\neventDict not in self._calEvents')
 
-        self._SaveCalData()
-        self.UpdateMonthDisplay()
+        if self._calTransactionDepth:
+            self._calTransactionChanged = True
+        else:
+            self.UpdateMonthDisplay()
 
     def SetupList(self, *a, **k):
         return self.setup_list(*a, **k)
@@ -1358,43 +2534,74 @@ class DirectoryNavigationClass:
                  btnNavUp=None,
                  limitStringLen=25,
                  lblMessage=None,
+                 lazyListing=False,
+                 readAhead=True,
+                 listingMaxAge=60,
+                 virtualized=False,
                  ):
+        '''
+        :param lazyListing: bool - True means UpdateData() with no data lists only the directories that are shown,
+            False means it reads the whole file system with File.ListDirWithSub()
+        :param readAhead: bool - with lazyListing, also list the subdirectories of the current directory in the background
+        :param listingMaxAge: float - with lazyListing, the seconds that a directory listing is reused for
+            (File has no modified time to check, so listings expire instead)
+        :param virtualized: bool - True means the table only holds the rows that are visible.
+            The rest of the directory is kept as a sorted list of (folderIcon, entry) and the scroll buttons move a
+            window over it, so large directories do not fill the ScrollingTable.
+        '''
 
         self._lblMessage = lblMessage
         self._limitStringLen = limitStringLen
         self._btnNavUp = btnNavUp
         self._lblCurrentDirectory = lblCurrentDirectory
 
+        self._virtualized = virtualized
+        self._virtualKeys = []  # with virtualized, every (folderIcon, entry) in the current directory, sorted like the table
+        self._virtualOffset = 0  # with virtualized, the index in self._virtualKeys of the top row of the table
+        self._virtualDirectory = None  # the directory self._virtualKeys was made for
+        self._rowCount = 0  # the number of rows registered with self.RegisterRow()
+        self._lvlScrollFeedback = lvlScrollFeedback
+        self._lblScrollText = lblScrollText
+
         self._table = ScrollingTable()
         self._table.set_table_header_order(['entry', 'folderIcon'])
         if btnScrollUp is not None:
-            self._table.register_scroll_up_button(btnScrollUp)
+            if not virtualized:
+                self._table.register_scroll_up_button(btnScrollUp)
             btnScrollUp._repeatTime = 0.1
             btnScrollUp._holdTime = 0.2
 
             @event(btnScrollUp, ['Pressed', 'Repeated'])
             def btnScrollUpEvent(button, state):
                 print('btnScrollUpEvent', state)
-                self._table.scroll_up()
+                if self._virtualized:
+                    self._ScrollVirtualWindow(-1)
+                else:
+                    self._table.scroll_up()
 
         if btnScrollDown is not None:
-            self._table.register_scroll_down_button(btnScrollDown)
+            if not virtualized:
+                self._table.register_scroll_down_button(btnScrollDown)
             btnScrollDown._repeatTime = 0.1
             btnScrollDown._holdTime = 0.2
 
             @event(btnScrollDown, ['Pressed', 'Repeated'])
             def btnScrollDownEvent(button, state):
-                self._table.scroll_down()
+                if self._virtualized:
+                    self._ScrollVirtualWindow(1)
+                else:
+                    self._table.scroll_down()
 
         if btnNavUp is not None:
             @event(btnNavUp, 'Released')
             def btnNavUpEvent(button, state):
                 self.NavigateUp()
 
-        if lvlScrollFeedback is not None:
+        # with virtualized, the scroll feedback is set by self._UpdateScrollFeedback()
+        if lvlScrollFeedback is not None and not virtualized:
             self._table.register_scroll_updown_level(lvlScrollFeedback)
 
-        if lblScrollText is not None:
+        if lblScrollText is not None and not virtualized:
             self._table.register_scroll_updown_label(lblScrollText)
 
         self._data = {
@@ -1407,8 +2614,17 @@ class DirectoryNavigationClass:
             # '/rootFolder3/folder3c/file3c2',
             # ]
         }
+        self._trie = PathTrieClass()  # self._data indexed by path, built by self.UpdateData()
         self._currentDirectory = '/'
 
+        self._lazyListing = lazyListing
+        self._readAhead = readAhead
+        self._listingLazily = False  # True when self._data is the internal file system listed one directory at a time
+        self._listingMaxAge = listingMaxAge
+        self._listedDirectories = {}  # path: time.monotonic() when its contents were added to self._trie
+        self._waitReadAhead = Wait(0.5, self._ReadAhead)
+        self._waitReadAhead.Cancel()
+
         self._waitUpdateTable = Wait(0.1, self._UpdateTable)
         self._waitUpdateTable.Cancel()
 
@@ -1447,6 +2663,7 @@ class DirectoryNavigationClass:
         if btnIcon._holdTime is None:
             btnIcon._holdTime = 1
         self._table.register_row_buttons(rowNumber, btnSelection, btnIcon)
+        self._rowCount = max(self._rowCount, rowNumber + 1)
 
     def NavigateUp(self):
         if self._currentDirectory != '/':
@@ -1455,21 +2672,103 @@ class DirectoryNavigationClass:
             self._waitUpdateTable.Restart()
 
     def UpdateData(self, newData=None):
-        print('UpdateData(newData={})'.format(newData))
+        print('UpdateData(newData={} items)'.format(None if newData is None else len(newData)))
+        self._listedDirectories = {}
+        self._waitReadAhead.Cancel()
+
+        # lazy listing only applies to the internal file system, data from the programmer is already complete
+        self._listingLazily = newData is None and self._lazyListing
+        if self._listingLazily:
+            # the directories are listed as they are shown, see self._ListDirectory()
+            self._data = []
+            self._trie = PathTrieClass()
+            self._UpdateTable()
+            return
+
         if newData is None:
             newData = File.ListDirWithSub()
         self._data = newData
+        self._trie = PathTrieClass(newData or [])
         self._UpdateTable()
 
+    def _ListDirectory(self, path):
+        '''
+        With lazyListing, puts the contents of one directory of the internal file system in self._trie.
+        The listing is reused until it is listingMaxAge seconds old.
+        :param path: str like '/folder1/'
+        :return:
+        '''
+        if not path.endswith('/'):
+            path += '/'
+
+        listedAt = self._listedDirectories.get(path, None)
+        if listedAt is not None and time.monotonic() - listedAt < self._listingMaxAge and self._trie.IsDirectory(path):
+            return
+
+        if path != '/' and not File.Exists(path):
+            self._trie.Remove(path)
+            self._listedDirectories.pop(path, None)
+            return
+
+        children = []
+        for name in File.ListDir(path):
+            children.append((name.rstrip('/').split('/')[-1], name.endswith('/')))
+
+        self._trie.SetChildren(path, children)
+        self._listedDirectories[path] = time.monotonic()
+
+    def PathAdded(self, path):
+        '''
+        Call this after a file or directory is created so it is shown without reading the whole file system again.
+        :param path: str - directories end with '/', like '/folder1/newFolder/'
+        :return:
+        '''
+        self._trie.Add(path)
+
+        if self._listingLazily:
+            if path.endswith('/'):
+                self._listedDirectories[path] = time.monotonic()  # a new directory is empty
+        elif self._data is not None:
+            self._data = list(self._data) + [path]
+
+        self._waitUpdateTable.Restart()
+
+    def PathRemoved(self, path):
+        '''
+        Call this after a file or directory is deleted so it is removed without reading the whole file system again.
+        :param path: str like '/folder1/file.txt' or '/folder1/oldFolder'
+        :return:
+        '''
+        self._trie.Remove(path)
+
+        directory = path.rstrip('/') + '/'
+        for listedPath in list(self._listedDirectories):
+            if listedPath.startswith(directory):
+                del self._listedDirectories[listedPath]
+
+        if not self._listingLazily and self._data is not None:
+            self._data = [item for item in self._data if item != path and not item.startswith(directory)]
+
+        self._waitUpdateTable.Restart()
+
+    def _ReadAhead(self):
+        # Runs in the background. Lists the subdirectories of the current directory, so opening one is instant.
+        currentDirectory = self._currentDirectory
+        for name, isDirectory in self._trie.ListDirectory(currentDirectory) or []:
+            if currentDirectory != self._currentDirectory:
+                return  # the user moved on
+
+            if isDirectory:
+                try:
+                    self._ListDirectory(currentDirectory + name + '/')
+                except Exception as e:
+                    print('DirectoryNavigationClass._ReadAhead Exception:', e)
+
     def _CurrentDirIsValid(self):
         if not self._currentDirectory.endswith('/'):
             return False
 
-        for item in self._data:
-            if self._currentDirectory in item:
-                return True
-
-        return False
+        return self._trie.IsDirectory(self._currentDirectory)
 
     def _UpdateTable(self):
         print('DirectoryNavigationClass._UpdateTable()')
@@ -1480,8 +2779,13 @@ class DirectoryNavigationClass:
             if self._directoryLock not in self._currentDirectory:
                 self._currentDirectory = self._directoryLock
 
+            if self._listingLazily:
+                self._ListDirectory(self._currentDirectory)
+
             if not self._CurrentDirIsValid():
                 self._currentDirectory = self._directoryLock
+                if self._listingLazily:
+                    self._ListDirectory(self._currentDirectory)
 
             print('_UpdateTable self._allowChangeDirectory=', self._allowChangeDirectory)
             print('_UpdateTable self._btnNavUp.Visible=', self._btnNavUp.Visible)
@@ -1515,51 +2819,35 @@ class DirectoryNavigationClass:
             # Update the table with data
             self._table.freeze(True)
 
-            print('_UpdateTable self._data=', self._data)
+            print('_UpdateTable len(self._data)=', None if self._data is None else len(self._data))
             if self._data is not None:
-                # Add missing data
-                currentData = []
-                for item in self._data:
-                    print('item=', item)
+                # The rows that should be in the table, sorted with the folders at the top
+                targetKeys = set()
+                for name, isDirectory in self._trie.ListDirectory(self._currentDirectory) or []:
                     # Determine if the item is a folder or file
-                    if item.startswith(self._currentDirectory):  # only deal with items in the current directory
-                        print('item.startswith(self._currentDirectory)')
-                        if self.IsInCurrentDirectory(item):
-                            print('self.IsInCurrentDirectory(item)')
-                            itemMinusCurrent = item[len(self._currentDirectory):]
-                            if itemMinusCurrent != '':
-                                print('itemMinusCurrent is not ""')
-
-                                if self.IsFile(item):
-                                    folderIcon = ' '
-                                    if not self._showFiles:
-                                        continue
-
-                                elif self.IsDirectory(item):
-                                    folderIcon = '\xb1'
-                                    itemMinusCurrent = itemMinusCurrent[
-                                                       :-1]  # chop off the extra '/' at the end of directories
-
-                                else:
-                                    folderIcon = '?'
-
-                                data = {'entry': str(itemMinusCurrent), 'folderIcon': folderIcon, }
-                                if not self._table.has_row(data):
-                                    self._table.add_new_row_data(data)
-                                currentData.append(data)
-
-                # remove leftover data
-                print('_UpdateTable currentData=', currentData)
-                print('_UpdateTable self._table.get_row_data()', self._table.get_row_data())
-                for row in self._table.get_row_data():
-                    if row not in currentData:
-                        self._table.delete_row(row)
-
-                # Sort with the folders at the top
-                self._table.sort_by_column_list([1, 0], reverse=True)
+                    if isDirectory:
+                        folderIcon = '\xb1'
+                    else:
+                        folderIcon = ' '
+                        if not self._showFiles:
+                            continue
+
+                    targetKeys.add((folderIcon, str(name)))
+
+                if self._virtualized:
+                    self._virtualKeys = sorted(targetKeys, reverse=True)
+                    if self._virtualDirectory != self._currentDirectory:
+                        self._virtualDirectory = self._currentDirectory
+                        self._virtualOffset = 0
+                    self._ScrollVirtualWindow(0)
+                else:
+                    self._UpdateRows(targetKeys)
 
                 self._table.freeze(False)
 
+                if self._listingLazily and self._readAhead:
+                    self._waitReadAhead.Restart()
+
             # Update the current directory label
             if self._lblCurrentDirectory is not None:
                 if self._data is not None:
@@ -1572,69 +2860,88 @@ class DirectoryNavigationClass:
             print('Exeption DirectoryNavigationClass._UpdateTable\n', e)
             # print('item=', item)
 
-    def IsFile(self, filepath):
-        print('IsFile(filepath={})'.format(filepath))
-        name = filepath.split('/')[-1]
-        if name == '':
-            print('IsFile return False')
-            return False
+    def _UpdateRows(self, targetKeys):
+        '''
+        Adds and removes rows so the table holds exactly targetKeys, sorted with the folders at the top
+        :param targetKeys: set of tuples like {('\xb1', 'folder1'), (' ', 'file.txt')}
+        :return:
+        '''
+        currentRows = self._table.get_row_data()
+        currentKeys = set((row['folderIcon'], row['entry']) for row in currentRows)
+
+        # remove leftover data, removing rows does not change the order of the others
+        for row in currentRows:
+            if (row['folderIcon'], row['entry']) not in targetKeys:
+                self._table.delete_row(row)
+
+        # Add missing data
+        newKeys = sorted(targetKeys - currentKeys, reverse=True)
+        for folderIcon, entry in newKeys:
+            self._table.add_new_row_data({'entry': entry, 'folderIcon': folderIcon, })
+
+        # Sort with the folders at the top,
+        # unless the new rows were all appended after the last row that is still in order
+        keptKeys = [
+            (row['folderIcon'], row['entry']) for row in currentRows
+            if (row['folderIcon'], row['entry']) in targetKeys
+        ]
+        if newKeys and keptKeys and min(keptKeys) <= newKeys[0]:
+            self._table.sort_by_column_list([1, 0], reverse=True)
 
-        for item in self._data:
-            if name in item:
-                if name == item.split('/')[-1]:
-                    print('IsFile return True')
-                    return True
+    def _ScrollVirtualWindow(self, step):
+        '''
+        With virtualized, moves the rows shown in the table through self._virtualKeys
+        :param step: int - the number of rows to scroll, negative scrolls up, 0 only makes sure the window is valid
+        :return:
+        '''
+        rowCount = self._rowCount or len(self._virtualKeys)
+        maxOffset = max(0, len(self._virtualKeys) - rowCount)
+        self._virtualOffset = min(max(0, self._virtualOffset + step), maxOffset)
+
+        self._table.freeze(True)
+        self._UpdateRows(set(self._virtualKeys[self._virtualOffset:self._virtualOffset + rowCount]))
+        self._table.freeze(False)
+
+        self._UpdateScrollFeedback(maxOffset)
+
+    def _UpdateScrollFeedback(self, maxOffset):
+        if self._lvlScrollFeedback is not None:
+            self._lvlScrollFeedback.SetRange(0, max(1, maxOffset))
+            self._lvlScrollFeedback.SetLevel(maxOffset - self._virtualOffset)  # the top of the level is the top of the list
+
+        if self._lblScrollText is not None:
+            if self._virtualKeys:
+                self._lblScrollText.SetText('{}-{} of {}'.format(
+                    self._virtualOffset + 1,
+                    min(self._virtualOffset + (self._rowCount or len(self._virtualKeys)), len(self._virtualKeys)),
+                    len(self._virtualKeys),
+                ))
+            else:
+                self._lblScrollText.SetText('')
 
-        print('IsFile return False')
-        return False
+    def IsFile(self, filepath):
+        print('IsFile(filepath={})'.format(filepath))
+        return self._trie.IsFile(filepath)
 
     def IsDirectory(self, path):
         print('IsDirectory(path={})'.format(path))
         # path may end in '/' or may not
-        # examples path='TEST1026', path='TEST1026/', path='image.png'(return False)
-        for item in self._data:
-            if item.endswith('/'):
-                # item is a directory
-                if item.endswith(path):
-                    print('IsDirectory return True')
-                    return True
-                else:
-                    name = path.split('/')[-1]
-                    if name == item.split('/')[-2]:
-                        # '/Farm_Network_Profiles/TEST1026/'.split('/') = ['', 'Farm_Network_Profiles', 'TEST1026', '']
-                        print('IsDirectory return True')
-                        return True
-
-        print('IsDirectory return False')
-        return False
+        # examples path='/TEST1026', path='/TEST1026/', path='/image.png'(return False)
+        return self._trie.IsDirectory(path)
 
     def IsInCurrentDirectory(self, filepath):
         # Return true if the item is in the current directory
         # Return false if it is in a super/sub directory
         print('IsInCurrentDirectory filepath=', filepath)
 
-        if filepath.startswith(self._currentDirectory):
-            pathMinusCurrent = filepath[len(self._currentDirectory):]
-            print('IsInCurrentDirectory pathMinusCurrent=', pathMinusCurrent)
-            print('self.IsDirectory({})='.format(filepath), self.IsDirectory(filepath))
-            print('self.IsFile({})='.format(filepath), self.IsFile(filepath))
-
-            if self.IsDirectory(filepath):
-                print('IsInCurrentDirectory IsDirectory')
-                print("len(pathMinusCurrent.split('/'))=", len(pathMinusCurrent.split('/')))
-                if len(pathMinusCurrent.split('/')) <= 2:
-                    return True
-                else:
-                    return False
-            elif self.IsFile(filepath):
-                print('IsInCurrentDirectory IsFile')
-                print("len(pathMinusCurrent.split('/'))=", len(pathMinusCurrent.split('/')))
-                if len(pathMinusCurrent.split('/')) == 1:
-                    return True
-                else:
-                    return False
+        if not filepath.startswith(self._currentDirectory):
+            return False
 
-        return False
+        pathMinusCurrent = filepath[len(self._currentDirectory):].rstrip('/')
+        if pathMinusCurrent == '' or '/' in pathMinusCurrent:
+            return False
+
+        return self._trie.Exists(filepath)
 
     def GetType(self, name):
         if self.IsFile(name):
@@ -1739,6 +3046,1332 @@ class DirectoryNavigationClass:
             self._UpdateTable()
 
 
+class PathTrieClass:
+    '''
+    Indexes a list of paths like the one from File.ListDirWithSub(), for example:
+    ['/rootfile1', '/rootFolder3/', '/rootFolder3/file3a', '/rootFolder3/folder3c/file3c1']
+    Directories end with '/'. The directories above a path are added even if they are not in the list.
+
+    Each directory is a dict of {name: child dict for a directory, or None for a file},
+        so a lookup costs one dict access per level of the path.
+    '''
+
+    def __init__(self, paths=None):
+        self._root = {}
+        for path in paths or []:
+            self.Add(path)
+
+    def Add(self, path):
+        names = self._Split(path)
+        if not names:
+            return
+
+        node = self._root
+        for name in names[:-1]:
+            child = node.get(name, None)
+            if child is None:
+                child = node[name] = {}
+            node = child
+
+        if path.endswith('/'):
+            if node.get(names[-1], None) is None:
+                node[names[-1]] = {}
+        else:
+            node.setdefault(names[-1], None)
+
+    def Remove(self, path):
+        # removes a file, or a directory and everything in it
+        names = self._Split(path)
+        if not names:
+            self._root.clear()
+            return
+
+        parent = self._Find('/'.join(names[:-1]))
+        if isinstance(parent, dict):
+            parent.pop(names[-1], None)
+
+    def SetChildren(self, path, children):
+        '''
+        Replaces the contents of one directory. The contents of the subdirectories that are still there are kept.
+        :param path: str like '/folder1/'
+        :param children: list of tuples like [('file.txt', False), ('folder2', True)]
+        :return:
+        '''
+        self.Add(path.rstrip('/') + '/')
+        node = self._Find(path)
+
+        newNode = {}
+        for name, isDirectory in children:
+            if isDirectory:
+                child = node.get(name, None)
+                newNode[name] = child if isinstance(child, dict) else {}
+            else:
+                newNode[name] = None
+
+        node.clear()
+        node.update(newNode)
+
+    def Exists(self, path):
+        return self._Find(path) is not self._MISSING
+
+    def IsFile(self, path):
+        if path.endswith('/'):
+            return False
+        return self._Find(path) is None
+
+    def IsDirectory(self, path):
+        return isinstance(self._Find(path), dict)
+
+    def ListDirectory(self, path):
+        '''
+        :param path: str like '/rootFolder3/'
+        :return: list of tuples like [('file3a', False), ('folder3c', True)], or None if path is not a directory
+        '''
+        node = self._Find(path)
+        if not isinstance(node, dict):
+            return None
+
+        return [(name, child is not None) for name, child in node.items()]
+
+    _MISSING = object()
+
+    def _Find(self, path):
+        # returns the dict of a directory, None for a file, or self._MISSING
+        node = self._root
+        for name in self._Split(path):
+            if not isinstance(node, dict):
+                return self._MISSING
+
+            node = node.get(name, self._MISSING)
+            if node is self._MISSING:
+                return self._MISSING
+
+        return node
+
+    @staticmethod
+    def _Split(path):
+        return [name for name in path.split('/') if name]
+
+
+class DisplayBroadcasterClass:
+    '''
+    Tells every UserInputClass instance that its calendar display is out of date.
+
+    Instances are held by weak reference, so an instance that is no longer used is dropped automatically.
+    MarkDirty() only flags the instances, they are redrawn together on the next frame,
+        so many changes in a row redraw each instance at most once.
+    Instances whose calendar is not showing are skipped, get_date() redraws them when they are shown.
+    '''
+
+    def __init__(self, frameTime=0.1):
+        self._frameTime = frameTime
+        self._instances = weakref.WeakSet()
+        self._dirty = weakref.WeakKeyDictionary()  # instance: the datetime.datetime to display
+        self._wait = None  # the Wait for the next frame, None when no frame is pending
+        self._lock = threading.Lock()  # _Frame() runs in the Wait thread, MarkDirty()/Rendered() in the callers thread
+
+    def Register(self, instance):
+        self._instances.add(instance)
+
+    def MarkDirty(self, dt=None):
+        '''
+        :param dt: datetime.datetime - the month to display, None keeps the month each instance is showing
+        :return:
+        '''
+        with self._lock:
+            for instance in list(self._instances):
+                self._dirty[instance] = dt
+
+            if self._wait is None:
+                self._wait = Wait(self._frameTime, self._Frame)
+
+    def Rendered(self, instance):
+        # the instance has just been drawn, so it is no longer dirty
+        with self._lock:
+            self._dirty.pop(instance, None)
+
+    def _Frame(self):
+        # anything marked dirty while this frame draws goes in the new dict, for the next frame
+        with self._lock:
+            self._wait = None
+            dirty = self._dirty
+            self._dirty = weakref.WeakKeyDictionary()
+
+        for instance, dt in list(dirty.items()):
+            if not getattr(instance, '_calShowing', False):
+                continue  # hidden or setup_calendar() was never called
+
+            try:
+                instance._calDisplayMonth(dt)
+            except Exception as e:
+                print('DisplayBroadcasterClass Exception:', e)
+
+
+class FrozenDictClass(dict):
+    '''
+    A dict that can not be changed.
+    It is still a dict, so isinstance(meta, dict) and json.dumps(meta) work like they did before the meta was read-only.
+    Use .copy() to get a plain dict that can be changed.
+    '''
+
+    def _ReadOnly(self, *args, **kwargs):
+        raise TypeError('{} does not support changes, use .copy()'.format(type(self).__name__))
+
+    __setitem__ = __delitem__ = _ReadOnly
+    update = pop = popitem = clear = setdefault = _ReadOnly
+    __ior__ = _ReadOnly
+
+    def __reduce__(self):
+        # copy.deepcopy()/pickle would otherwise fill the new dict with __setitem__
+        return type(self), (dict(self),)
+
+
+class CalendarEventClass(collections.abc.Mapping):
+    '''
+    The compact record that the calendar keeps for each event.
+
+    It reads like the eventDict it replaces, so eventDict['name'], eventDict.get('End Time') etc still work:
+    {
+    'datetime': dt, #datetime.datetime object representing the time the event is happening
+    'name': 'Name Of The Event', #str representing the name of the event
+    'meta': {'Room Number': 'Room 101'}, #dict with any custom values that the user may want to hold about the event
+    'Start Time': dt, #the same object as 'datetime'
+    'End Time': dt, #datetime.datetime or None
+    'ID': 'a1b2c3', #str
+    }
+    Recurring events also have a 'Recurrence' key and their occurrences have a 'Series ID' key.
+
+    The record is read-only, including its 'meta', changes are made by adding a new event with the same ID.
+    Use .copy() to get a plain dict.
+    '''
+    __slots__ = ('_start', '_name', '_meta', '_end', '_ID', '_recurrence', '_seriesID')
+
+    _ATTRS = collections.OrderedDict([
+        ('datetime', '_start'),
+        ('name', '_name'),
+        ('meta', '_meta'),
+        ('Start Time', '_start'),
+        ('End Time', '_end'),
+        ('ID', '_ID'),
+        ('Recurrence', '_recurrence'),
+        ('Series ID', '_seriesID'),
+    ])
+    _OPTIONAL = ('Recurrence', 'Series ID')  # these keys only exist when they have a value
+
+    EMPTY_META = FrozenDictClass()  # shared by all the events without meta
+
+    def __init__(self, startDT, name, meta=None, endDT=None, ID=None, recurrence=None, seriesID=None):
+        self._start = startDT
+        self._name = sys.intern(name) if isinstance(name, str) else name
+        # a read-only copy, so changing the caller's dict or eventDict['meta'] cannot change the indexed event
+        self._meta = FrozenDictClass(meta) if meta else self.EMPTY_META
+        self._end = endDT
+        self._ID = ID
+        self._recurrence = recurrence
+        self._seriesID = seriesID
+
+    def __getitem__(self, key):
+        value = getattr(self, self._ATTRS[key])
+        if value is None and key in self._OPTIONAL:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for key, attr in self._ATTRS.items():
+            if key not in self._OPTIONAL or getattr(self, attr) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __eq__(self, other):
+        if isinstance(other, CalendarEventClass):
+            return all(getattr(self, attr) == getattr(other, attr) for attr in self.__slots__)
+        return collections.abc.Mapping.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def copy(self):
+        result = dict(self.items())
+        result['meta'] = dict(self._meta)
+        return result
+
+
+class CalendarStorageClass:
+    '''
+    Saves the calendar events in one shard per month, plus one shard for the recurring events.
+
+    Each shard is a snapshot file plus an append-only journal,
+    for example 'calendar/2026-03.json' and 'calendar/2026-03.journal'.
+    Each add/update/delete is queued in memory and Flush() appends the queue to the journal of its shard,
+    one compact json line per record, so that a burst of changes is one write.
+    QueueSnapshot() queues a rewrite of the snapshot of a shard, which folds its journal back into it.
+    Snapshots are written to a temp file that is then renamed over the old one,
+    so a power cut mid-write leaves either the old or the new snapshot.
+
+    Old months can be moved to a gzip compressed archive with QueueArchive(), for example 'calendar/archive/2024-03.json.gz'.
+
+    Flush() does all the writing, so it can run in a single background writer.
+    ReadShard() and ReadArchivedShard() include the queued writes, so they are correct before Flush() has run.
+
+    Format 1 is a pretty-printed list of eventDicts with every datetime saved as a GetDatetimeKwargs() dict.
+    Format 2 is {"version": 2, "events": [...]} without indentation,
+        each event is a list like [startTimestamp, endTimestamp, name, ID, meta] plus a recurrence list if it has one.
+    Both formats can be read, files that are not in formatVersion are rewritten when they are loaded.
+
+    Older versions of this module only read a single calendar.json, so with formatVersion 1 Flush() also writes every
+        event to legacyFilename before it writes the shards, and MigrateLegacy() reloads the shards from it,
+        which picks up any changes an older version made to it.
+    '''
+    RECURRING = 'recurring'  # the shard key for events with a 'Recurrence'
+    FORMAT_VERSIONS = (1, 2)
+
+    def __init__(self, directory='calendar', maxJournalRecords=200, legacyFilename='calendar.json', formatVersion=2):
+        if formatVersion not in self.FORMAT_VERSIONS:
+            raise Exception('Unknown calendar formatVersion {}'.format(formatVersion))
+
+        self._directory = directory
+        self._formatVersion = formatVersion
+        self._legacyFilename = legacyFilename
+        self._maxJournalRecords = maxJournalRecords
+        self._journalRecords = {}  # shardKey: number of records in its journal
+        self._versions = {}  # shardKey: int that changes every time the shard is written
+        self._shardKeys = None  # set of the shards on disk, listed once
+        self._archivedShardKeys = None  # set of the archived shards on disk, listed once
+        self._pendingRecords = collections.OrderedDict()  # shardKey: list of records waiting for Flush()
+        self._pendingWrites = collections.OrderedDict()  # shardKey: list of ('snapshot' or 'archive', list of eventDicts)
+        #                                                   or ('archive-delete', list of IDs)
+        self._tornJournals = set()  # shardKeys whose last append failed, so the journal may end with a torn record
+        self._lock = threading.RLock()  # guards the queues, it is never held while a file is written
+        self._flushLock = threading.Lock()  # one Flush() at a time
+
+    def ListShards(self):
+        '''
+        :return: set of the shard keys that have been saved, like {'recurring', '2026-02', '2026-03'}
+        '''
+        if self._shardKeys is None:
+            shardKeys = set()
+            if File.Exists(self._directory):
+                for name in File.ListDir(self._directory):
+                    name = name.rstrip('/').split('/')[-1]
+                    if name.endswith('.json.tmp'):
+                        name = name[:-len('.tmp')]  # a snapshot that was not renamed yet, see self._WriteFile()
+                    if name.endswith('.json') or name.endswith('.journal'):
+                        shardKeys.add(name.rsplit('.', 1)[0])
+            self._shardKeys = shardKeys
+
+        return self._shardKeys
+
+    def ReadShard(self, shardKey):
+        '''
+        Replays the snapshot plus the journal of one shard, then the writes that are waiting for Flush().
+        This only reads files, so it is safe to call from a background Wait.
+        :param shardKey: str
+        :return: tuple like (collections.OrderedDict of ID -> eventDict,
+            bool True if the shard has a journal or its snapshot is not in formatVersion)
+        '''
+        # the queue is copied before the files are read, so a write that Flush() finishes in between is not missed
+        with self._lock:
+            pendingWrites = list(self._pendingWrites.get(shardKey, []))
+            pendingRecords = list(self._pendingRecords.get(shardKey, []))
+
+        events, needsCompaction = self._ReadFiles(self._GetSnapshotFilename(shardKey), self._GetJournalFilename(shardKey))
+
+        for kind, eventDicts in pendingWrites:
+            if kind == 'archive-delete':
+                continue  # only changes the archive
+
+            events = collections.OrderedDict()  # an archived shard is empty
+            if kind == 'snapshot':
+                for eventDict in eventDicts:
+                    events[eventDict['ID']] = eventDict
+            needsCompaction = False
+
+        for record in pendingRecords:
+            self._ApplyRecord(events, record)
+
+        return events, needsCompaction
+
+    def MigrateLegacy(self):
+        '''
+        Moves the events from a single calendar.json (and its journal) into month shards.
+        With formatVersion 1 calendar.json is kept for older versions of this module, see self._WriteLegacyFile()
+        :return:
+        '''
+        if not File.Exists(self._legacyFilename):
+            if self._formatVersion == 1:
+                self._WriteLegacyFile()
+            return
+
+        legacyJournalFilename = self._legacyFilename.rsplit('.', 1)[0] + '.journal'
+        events, needsCompaction = self._ReadFiles(self._legacyFilename, legacyJournalFilename)
+
+        shards = {}
+        for eventDict in events.values():
+            shards.setdefault(self.GetShardKey(eventDict), []).append(eventDict)
+
+        # a month can be archived before calendar.json is written again without it, those events are not restored
+        archivedEvents = False
+        for shardKey in set(shards) & self.ListArchivedShards():
+            archivedIDs = self._ReadArchiveFile(shardKey)
+            eventDicts = [eventDict for eventDict in shards[shardKey] if eventDict['ID'] not in archivedIDs]
+            archivedEvents = archivedEvents or len(eventDicts) != len(shards[shardKey])
+            if eventDicts or shardKey in self.ListShards():
+                shards[shardKey] = eventDicts
+            else:
+                del shards[shardKey]
+
+        if self._formatVersion == 1:
+            # calendar.json has every event, so a month that is not in it has had all its events deleted
+            for shardKey in self.ListShards():
+                shards.setdefault(shardKey, [])
+
+        for shardKey, eventDicts in shards.items():
+            self.CompactShard(shardKey, eventDicts)
+
+        if File.Exists(legacyJournalFilename):
+            File.DeleteFile(legacyJournalFilename)
+
+        if self._formatVersion != 1:
+            File.DeleteFile(self._legacyFilename)
+        elif archivedEvents:
+            self._WriteLegacyFile()
+
+    def _WriteLegacyFile(self):
+        '''
+        Writes every event that is not archived to calendar.json, like older versions of this module did.
+        The queued writes are included, so this can be written before the shards.
+        :return:
+        '''
+        with self._lock:
+            shardKeys = sorted(self.ListShards())
+
+        saveItems = []
+        for shardKey in shardKeys:
+            events, needsCompaction = self.ReadShard(shardKey)
+            for eventDict in events.values():
+                saveItem = self._EncodeEventV1(eventDict)
+                if saveItem['End Time'] is None:
+                    # older versions cannot load an event without one, _DecodeEventV1() removes it again
+                    saveItem['End Time'] = saveItem['Start Time']
+                    saveItem['No End Time'] = True
+                saveItems.append(saveItem)
+
+        self._WriteFile(self._legacyFilename, json.dumps(saveItems, indent=4))
+
+    def ListArchivedShards(self):
+        '''
+        :return: set of the month shard keys that have been archived, like {'2024-01', '2024-02'}
+        '''
+        if self._archivedShardKeys is None:
+            shardKeys = set()
+            if File.Exists(self._GetArchiveDirectory()):
+                for name in File.ListDir(self._GetArchiveDirectory()):
+                    name = name.rstrip('/').split('/')[-1]
+                    if name.endswith('.json.gz'):
+                        shardKeys.add(name[:-len('.json.gz')])
+            self._archivedShardKeys = shardKeys
+
+        return self._archivedShardKeys
+
+    def ReadArchivedShard(self, shardKey):
+        '''
+        :param shardKey: str
+        :return: collections.OrderedDict of ID -> eventDict
+        '''
+        with self._lock:
+            pendingWrites = list(self._pendingWrites.get(shardKey, []))
+
+        events = self._ReadArchiveFile(shardKey)
+
+        for kind, items in pendingWrites:
+            if kind == 'archive':
+                for eventDict in items:
+                    events.pop(eventDict['ID'], None)
+                    events[eventDict['ID']] = eventDict
+
+            elif kind == 'archive-delete':
+                for ID in items:
+                    events.pop(ID, None)
+
+        return events
+
+    def _ReadArchiveFile(self, shardKey):
+        events = collections.OrderedDict()
+
+        archiveFilename = self._GetArchiveFilename(shardKey)
+        self._RecoverTempFile(archiveFilename)
+        if File.Exists(archiveFilename):
+            with File(archiveFilename, mode='rb') as file:
+                saveItems, version = self._LoadEvents(gzip.decompress(file.read()).decode())
+                file.close()
+
+            for saveItem in saveItems:
+                eventDict = self._DecodeEvent(saveItem)
+                events[eventDict['ID']] = eventDict
+
+        return events
+
+    def QueueArchive(self, shardKey, eventDicts):
+        '''
+        Queues moving the eventDicts of one month shard to the archive, merged with anything already archived for that month.
+        The records and snapshot already queued for the shard are dropped, eventDicts must include them.
+        :param shardKey: str
+        :param eventDicts: iterable of all the eventDicts in the shard
+        :return:
+        '''
+        with self._lock:
+            self._pendingRecords.pop(shardKey, None)
+
+            writes = [write for write in self._pendingWrites.get(shardKey, []) if write[0] != 'snapshot']
+            writes.append(('archive', list(eventDicts)))
+            self._pendingWrites[shardKey] = writes
+
+            self.ListShards().discard(shardKey)
+            self.ListArchivedShards().add(shardKey)
+            self._versions[shardKey] = self._versions.get(shardKey, 0) + 1
+
+    def ArchiveShard(self, shardKey, eventDicts):
+        '''
+        Moves the eventDicts of one month shard to the archive now, merged with anything already archived for that month.
+        The snapshot and journal of the shard are deleted once the archive has been written.
+        Flush() calls this for QueueArchive().
+        :param shardKey: str
+        :param eventDicts: iterable of all the eventDicts in the shard
+        :return:
+        '''
+        events = self._ReadArchiveFile(shardKey)
+        for eventDict in eventDicts:
+            events.pop(eventDict['ID'], None)
+            events[eventDict['ID']] = eventDict
+
+        data = self._DumpEvents(events.values())
+
+        self._MakeDirectory()
+        if not File.Exists(self._GetArchiveDirectory()):
+            File.MakeDir(self._GetArchiveDirectory())
+
+        self._WriteFile(self._GetArchiveFilename(shardKey), gzip.compress(data.encode()), mode='wb')
+
+        for filename in [self._GetSnapshotFilename(shardKey), self._GetJournalFilename(shardKey)]:
+            if File.Exists(filename):
+                File.DeleteFile(filename)
+
+        with self._lock:
+            self.ListArchivedShards().add(shardKey)
+            self._journalRecords.pop(shardKey, None)
+            self._tornJournals.discard(shardKey)
+            self._versions[shardKey] = self._versions.get(shardKey, 0) + 1
+            self.ListShards().discard(shardKey)
+
+    def QueueArchiveDelete(self, shardKey, IDs):
+        '''
+        Queues removing some events from the archive of one month shard.
+        :param shardKey: str
+        :param IDs: iterable of the IDs of the archived events
+        :return:
+        '''
+        with self._lock:
+            self._pendingWrites.setdefault(shardKey, []).append(('archive-delete', list(IDs)))
+
+    def DeleteArchived(self, shardKey, IDs):
+        '''
+        Rewrites the archive of one month shard now without some of its events.
+        Flush() calls this for QueueArchiveDelete().
+        :param shardKey: str
+        :param IDs: iterable of the IDs of the archived events
+        :return:
+        '''
+        events = self._ReadArchiveFile(shardKey)
+        for ID in IDs:
+            events.pop(ID, None)
+
+        data = self._DumpEvents(events.values())
+        self._WriteFile(self._GetArchiveFilename(shardKey), gzip.compress(data.encode()), mode='wb')
+
+    def MakePutRecord(self, eventDict):
+        '''
+        Encodes an eventDict for RecordPut().
+        This raises if the event can not be saved, so the caller can check before it changes anything.
+        :param eventDict:
+        :return: dict
+        '''
+        record = {'op': 'put', 'event': self._EncodeEvent(eventDict)}
+        try:
+            json.dumps(record)  # otherwise this would fail in Flush(), which would keep trying to write it
+        except (TypeError, ValueError) as e:
+            raise Exception('Exception in MakePutRecord\nEvent {} can not be saved\n{}'.format(eventDict['ID'], e))
+        return record
+
+    def RecordPut(self, eventDict, record=None):
+        if record is None:
+            record = self.MakePutRecord(eventDict)
+        self._Record(self.GetShardKey(eventDict), record)
+
+    def RecordDelete(self, eventDict):
+        self._Record(self.GetShardKey(eventDict), {'op': 'del', 'ID': eventDict['ID']})
+
+    def QueueSnapshot(self, shardKey, eventDicts):
+        '''
+        Queues rewriting the snapshot of one shard, which also clears its journal.
+        The records already queued for the shard are dropped, eventDicts must include them.
+        :param shardKey: str
+        :param eventDicts: iterable of all the eventDicts in the shard
+        :return:
+        '''
+        with self._lock:
+            self._pendingRecords.pop(shardKey, None)
+
+            # an older snapshot that has not been written yet is replaced, a queued archive must still be written first
+            writes = [write for write in self._pendingWrites.get(shardKey, []) if write[0] != 'snapshot']
+            writes.append(('snapshot', list(eventDicts)))
+            self._pendingWrites[shardKey] = writes
+
+            self.ListShards().add(shardKey)
+            self._versions[shardKey] = self._versions.get(shardKey, 0) + 1
+
+    def Flush(self):
+        '''
+        Writes the queued snapshots, archives and records, with a single journal write per shard.
+        The queue is copied under self._lock and the files are written without it,
+            so RecordPut()/RecordDelete()/ReadShard() never wait for a file to be written.
+        Each write is removed from the queue once it is on disk. A shard that cannot be written keeps its queue,
+            so nothing is lost and the next Flush() tries it again.
+        The archives are written first. With formatVersion 1 the legacy file is written next,
+            so a month is only left out of it once it is in the archive, then the rest.
+        Raises the first exception after every shard has been tried.
+        :return:
+        '''
+        with self._flushLock:
+            with self._lock:
+                pendingWrites = collections.OrderedDict(
+                    (shardKey, list(writes)) for shardKey, writes in self._pendingWrites.items()
+                )
+                pendingRecords = collections.OrderedDict(
+                    (shardKey, list(records)) for shardKey, records in self._pendingRecords.items()
+                )
+
+            # the writes of a shard up to its last archive
+            archiveWrites = collections.OrderedDict()
+            for shardKey, writes in pendingWrites.items():
+                kinds = [kind for kind, eventDicts in writes]
+                if 'archive' in kinds:
+                    lastArchive = len(kinds) - kinds[::-1].index('archive')
+                    archiveWrites[shardKey] = writes[:lastArchive]
+                    pendingWrites[shardKey] = writes[lastArchive:]
+
+            shardKeys = list(pendingWrites)
+            shardKeys += [shardKey for shardKey in pendingRecords if shardKey not in pendingWrites]
+
+            error = None
+            failedShardKeys = set()
+            for shardKey, writes in archiveWrites.items():
+                try:
+                    self._FlushShard(shardKey, writes, [])
+                except Exception as e:
+                    print('CalendarStorageClass.Flush Exception:', shardKey, e)
+                    failedShardKeys.add(shardKey)
+                    if error is None:
+                        error = e
+
+            if shardKeys and self._formatVersion == 1:
+                if error is not None:
+                    # the legacy file would leave out a month that is not in the archive
+                    raise error
+                # if this fails only the archives have been written, everything else stays queued
+                self._WriteLegacyFile()
+
+            for shardKey in shardKeys:
+                if shardKey in failedShardKeys:
+                    continue  # the rest of the shard has to be written after its archive
+                try:
+                    self._FlushShard(shardKey, pendingWrites.get(shardKey, []), pendingRecords.get(shardKey, []))
+                except Exception as e:
+                    print('CalendarStorageClass.Flush Exception:', shardKey, e)
+                    if error is None:
+                        error = e
+
+            if error is not None:
+                raise error
+
+    def _FlushShard(self, shardKey, writes, records):
+        for write in writes:
+            kind, items = write
+            if kind == 'archive':
+                self.ArchiveShard(shardKey, items)
+            elif kind == 'archive-delete':
+                self.DeleteArchived(shardKey, items)
+            else:
+                self.CompactShard(shardKey, items)
+            self._Dequeue(self._pendingWrites, shardKey, [write])
+
+        if records:
+            self._Append(shardKey, records)
+            self._Dequeue(self._pendingRecords, shardKey, records)
+
+    def _Dequeue(self, queue, shardKey, written):
+        # removes the items that were written, the items that were queued while they were written stay queued
+        writtenIDs = set(id(item) for item in written)
+        with self._lock:
+            items = [item for item in queue.get(shardKey, []) if id(item) not in writtenIDs]
+            if items:
+                queue[shardKey] = items
+            else:
+                queue.pop(shardKey, None)
+
+    def HasPendingRecords(self):
+        # True if Flush() has something to write
+        with self._lock:
+            return bool(self._pendingRecords or self._pendingWrites)
+
+    def GetJournaledShards(self):
+        # the shards with a journal on disk or records waiting for Flush()
+        with self._lock:
+            return [
+                shardKey for shardKey, count in self._journalRecords.items() if count
+            ] + [
+                shardKey for shardKey in self._pendingRecords if not self._journalRecords.get(shardKey, 0)
+            ]
+
+    def GetFullJournals(self):
+        # the shards whose journal will be past maxJournalRecords once the queued records are written
+        with self._lock:
+            return [
+                shardKey for shardKey in self.GetJournaledShards()
+                if self._journalRecords.get(shardKey, 0) + len(self._pendingRecords.get(shardKey, [])) >= self._maxJournalRecords
+            ]
+
+    def GetVersion(self, shardKey):
+        return self._versions.get(shardKey, 0)
+
+    def CompactShard(self, shardKey, eventDicts):
+        '''
+        Writes all the eventDicts of one shard to its snapshot file now and clears its journal.
+        Flush() calls this for QueueSnapshot().
+        :param shardKey: str
+        :param eventDicts: iterable of eventDicts
+        :return:
+        '''
+        data = self._DumpEvents(eventDicts, indent=4)
+
+        self._WriteFile(self._GetSnapshotFilename(shardKey), data)
+
+        # the snapshot has every event of the shard, so the journal is no longer needed
+        journalFilename = self._GetJournalFilename(shardKey)
+        if File.Exists(journalFilename):
+            File.DeleteFile(journalFilename)
+
+        with self._lock:
+            self._journalRecords[shardKey] = 0
+            self._tornJournals.discard(shardKey)
+            self._Written(shardKey)
+
+    @classmethod
+    def GetShardKey(cls, eventDict):
+        if eventDict.get('Recurrence', None):
+            return cls.RECURRING
+
+        return cls.GetMonthShardKey(eventDict['datetime'])
+
+    @staticmethod
+    def GetMonthShardKey(dt):
+        return '{:04d}-{:02d}'.format(dt.year, dt.month)
+
+    @staticmethod
+    def GetMonthShardKeys(startDT, endDT):
+        '''
+        :return: list of the month shard keys from startDT to endDT, both included
+        '''
+        result = []
+        year, month = startDT.year, startDT.month
+        while (year, month) <= (endDT.year, endDT.month):
+            result.append('{:04d}-{:02d}'.format(year, month))
+            month += 1
+            if month > 12:
+                year += 1
+                month = 1
+        return result
+
+    @staticmethod
+    def GetMonthNumber(shardKey):
+        # '2026-03' > 24315, used to measure how far apart two months are
+        year, month = shardKey.split('-')
+        return int(year) * 12 + int(month)
+
+    def _GetSnapshotFilename(self, shardKey):
+        return '{}/{}.json'.format(self._directory, shardKey)
+
+    def _GetJournalFilename(self, shardKey):
+        return '{}/{}.journal'.format(self._directory, shardKey)
+
+    def _GetArchiveDirectory(self):
+        return '{}/archive'.format(self._directory)
+
+    def _GetArchiveFilename(self, shardKey):
+        return '{}/{}.json.gz'.format(self._GetArchiveDirectory(), shardKey)
+
+    def _MakeDirectory(self):
+        if not File.Exists(self._directory):
+            File.MakeDir(self._directory)
+
+    def _WriteFile(self, filename, data, mode='wt'):
+        # write a temp file then rename it over the old file, so the old file stays complete until the new one is
+        tempFilename = filename + '.tmp'
+
+        self._MakeDirectory()
+        with File(tempFilename, mode=mode) as file:
+            file.write(data)
+            file.close()
+
+        try:
+            File.Rename(tempFilename, filename)
+        except Exception as e:
+            # some file systems will not rename over an existing file
+            print('CalendarStorageClass._WriteFile Exception:', e)
+            if File.Exists(filename):
+                File.DeleteFile(filename)
+            File.Rename(tempFilename, filename)
+
+    def _RecoverTempFile(self, filename):
+        # power was lost after the old file was deleted but before the temp file was renamed
+        tempFilename = filename + '.tmp'
+        if not File.Exists(filename) and File.Exists(tempFilename):
+            print('CalendarStorageClass recovering', tempFilename)
+            File.Rename(tempFilename, filename)
+
+    def _Written(self, shardKey):
+        self._versions[shardKey] = self._versions.get(shardKey, 0) + 1
+        self.ListShards().add(shardKey)
+
+    def _ReadFiles(self, snapshotFilename, journalFilename):
+        # A torn record at the end of the journal (power lost mid-write) is dropped.
+        events = collections.OrderedDict()
+        needsCompaction = False
+
+        self._RecoverTempFile(snapshotFilename)
+        if File.Exists(snapshotFilename):
+            with File(snapshotFilename, mode='rt') as file:
+                saveItems, version = self._LoadEvents(file.read())
+                file.close()
+
+            for saveItem in saveItems:
+                eventDict = self._DecodeEvent(saveItem)
+                events[eventDict['ID']] = eventDict
+
+            needsCompaction = version != self._formatVersion
+
+        hasJournal = File.Exists(journalFilename)
+        if hasJournal:
+            with File(journalFilename, mode='rt') as file:
+                lines = file.read().split('\n')
+                file.close()
+
+            # every complete record ends with '\n', so the last item is either '' or a torn record
+            for line in lines[:-1]:
+                if not line:
+                    continue  # see self._Append()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a torn record, the append that tore it is written again after it
+                    print('CalendarStorageClass dropping bad record', line)
+                    continue
+                self._ApplyRecord(events, record)
+
+        return events, needsCompaction or hasJournal
+
+    def _Record(self, shardKey, record):
+        with self._lock:
+            self._pendingRecords.setdefault(shardKey, []).append(record)
+            self.ListShards().add(shardKey)
+            self._versions[shardKey] = self._versions.get(shardKey, 0) + 1
+
+    def _Append(self, shardKey, records):
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        if shardKey in self._tornJournals:
+            data = '\n' + data  # end the torn record, so the first record here is not joined to it
+
+        self._MakeDirectory()
+        try:
+            with File(self._GetJournalFilename(shardKey), mode='at') as file:
+                file.write(data)
+                file.close()
+        except Exception:
+            with self._lock:
+                self._tornJournals.add(shardKey)
+            raise
+
+        with self._lock:
+            self._tornJournals.discard(shardKey)
+            self._journalRecords[shardKey] = self._journalRecords.get(shardKey, 0) + len(records)
+            self._Written(shardKey)
+
+    def _ApplyRecord(self, events, record):
+        if record['op'] == 'put':
+            eventDict = self._DecodeEvent(record['event'])
+            events.pop(eventDict['ID'], None)  # an updated event moves to the end
+            events[eventDict['ID']] = eventDict
+
+        elif record['op'] == 'del':
+            events.pop(record['ID'], None)
+
+    def _DumpEvents(self, eventDicts, indent=None):
+        # returns the json str of a snapshot in self._formatVersion, format 2 is never indented
+        saveItems = [self._EncodeEvent(eventDict) for eventDict in eventDicts]
+
+        if self._formatVersion == 1:
+            return json.dumps(saveItems, indent=indent, separators=None if indent else (',', ':'))
+
+        return json.dumps({'version': 2, 'events': saveItems}, separators=(',', ':'))
+
+    @staticmethod
+    def _LoadEvents(data):
+        # returns a tuple like (list of saveItems, int formatVersion), format 1 files are a bare list
+        data = json.loads(data)
+        if isinstance(data, list):
+            return data, 1
+
+        return data['events'], data['version']
+
+    def _EncodeEvent(self, eventDict):
+        if self._formatVersion == 1:
+            return self._EncodeEventV1(eventDict)
+
+        saveItem = [
+            GetTimestamp(eventDict['datetime']),
+            GetTimestamp(eventDict.get('End Time', None)),
+            eventDict['name'],
+            eventDict['ID'],
+            dict(eventDict['meta']),
+        ]
+
+        recurrence = eventDict.get('Recurrence', None)
+        if recurrence:
+            saveItem.append([
+                recurrence['freq'],
+                recurrence['interval'],
+                recurrence['count'],
+                GetTimestamp(recurrence['until']),
+                [date.toordinal() for date in recurrence['exdates']],
+            ])
+
+        return saveItem
+
+    def _DecodeEvent(self, saveItem):
+        if isinstance(saveItem, dict):
+            return self._DecodeEventV1(saveItem)
+
+        recurrence = None
+        if len(saveItem) > 5:
+            freq, interval, count, until, exdates = saveItem[5]
+            recurrence = GetRecurrenceDict({
+                'freq': freq,
+                'interval': interval,
+                'count': count,
+                'until': GetDatetimeFromTimestamp(until),
+                'exdates': [datetime.date.fromordinal(ordinal) for ordinal in exdates],
+            })
+
+        start, end, name, ID, meta = saveItem[:5]
+        return CalendarEventClass(
+            GetDatetimeFromTimestamp(start),
+            name,
+            meta,
+            GetDatetimeFromTimestamp(end),
+            ID,
+            recurrence,
+        )
+
+    def _EncodeEventV1(self, eventDict):
+        saveItem = {
+            'datetime': GetDatetimeKwargs(eventDict['datetime']),
+            'name': eventDict['name'],
+            'meta': dict(eventDict['meta']),
+            'Start Time': GetDatetimeKwargs(eventDict.get('Start Time', None)),
+            'End Time': GetDatetimeKwargs(eventDict.get('End Time', None)),
+            'ID': eventDict.get('ID', None),
+        }
+
+        recurrence = eventDict.get('Recurrence', None)
+        if recurrence:
+            saveItem['Recurrence'] = {
+                'freq': recurrence['freq'],
+                'interval': recurrence['interval'],
+                'count': recurrence['count'],
+                'until': GetDatetimeKwargs(recurrence['until']),
+                'exdates': [date.strftime('%Y-%m-%d') for date in recurrence['exdates']],
+            }
+
+        return saveItem
+
+    def _DecodeEventV1(self, saveItem):
+        recurrence = saveItem.get('Recurrence', None)
+        if recurrence:
+            recurrence = GetRecurrenceDict({
+                'freq': recurrence['freq'],
+                'interval': recurrence['interval'],
+                'count': recurrence['count'],
+                'until': GetDatetimeFromKwargs(recurrence['until']),
+                'exdates': [datetime.datetime.strptime(date, '%Y-%m-%d').date() for date in recurrence['exdates']],
+            })
+
+        endTime = saveItem.get('End Time', None)
+        if saveItem.get('No End Time', False) and endTime == saveItem.get('Start Time', None):
+            endTime = None  # only put in calendar.json for older versions, see self._WriteLegacyFile()
+
+        return CalendarEventClass(
+            GetDatetimeFromKwargs(saveItem['datetime']),
+            saveItem['name'],
+            saveItem['meta'],
+            GetDatetimeFromKwargs(endTime),
+            saveItem.get('ID', None) or GetRandomHash(),  # older files may not have an ID
+            recurrence,
+        )
+
+
+class MonthCacheClass:
+    '''
+    A small LRU cache of rendered month grids.
+    Each entry remembers the first and last date of its 6-week grid,
+    so a change to one date only drops the months that show that date.
+    Every invalidation changes the generation, so a grid that was built from older events can be refused by Put().
+    '''
+
+    def __init__(self, maxSize=6):
+        self._maxSize = maxSize
+        self._entries = collections.OrderedDict()  # key: (firstDate, lastDate, value)
+        self._generation = 0
+
+    def Get(self, key):
+        entry = self._entries.get(key, None)
+        if entry is None:
+            return None
+
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def GetGeneration(self):
+        return self._generation
+
+    def Put(self, key, value, firstDate, lastDate, generation=None):
+        '''
+        :param generation: int from self.GetGeneration() before value was built, the value is dropped if it is stale
+        :return:
+        '''
+        if generation is not None and generation != self._generation:
+            return
+
+        self._entries[key] = (firstDate, lastDate, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self._maxSize:
+            self._entries.popitem(last=False)
+
+    def InvalidateRange(self, startDate, endDate=None):
+        '''
+        Drops every month whose grid shows a date from startDate to endDate
+        :param startDate: datetime.date
+        :param endDate: datetime.date or None, None means no end
+        :return:
+        '''
+        self._generation += 1
+        for key, (firstDate, lastDate, value) in list(self._entries.items()):
+            if lastDate >= startDate and (endDate is None or firstDate <= endDate):
+                del self._entries[key]
+
+    def Clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+
+class EventIntervalIndexClass:
+    '''
+    Index of the event spans from 'Start Time' to 'End Time'.
+
+    Events are kept sorted by start time along with a sorted list of their durations.
+    An event can only overlap a window if it starts before the window ends and
+    no earlier than the window start minus the longest duration, so every query
+    is a bisect plus a check of the events in that range.
+    An event with no 'End Time' is treated as a single moment.
+    '''
+
+    def __init__(self):
+        self._starts = []  # sorted list of (startDT, ID, eventDict)
+        self._durations = []  # sorted list of datetime.timedelta
+
+    def __len__(self):
+        return len(self._starts)
+
+    def Add(self, eventDict):
+        start, end = self.GetSpan(eventDict)
+        bisect.insort(self._starts, (start, eventDict['ID'], eventDict))
+        bisect.insort(self._durations, end - start)
+
+    def Remove(self, eventDict):
+        start, end = self.GetSpan(eventDict)
+
+        index = bisect.bisect_left(self._starts, (start, eventDict['ID']))
+        if index < len(self._starts) and self._starts[index][2] is eventDict:
+            del self._starts[index]
+
+            index = bisect.bisect_left(self._durations, end - start)
+            del self._durations[index]
+
+    def Overlapping(self, startDT, endDT):
+        '''
+        :return: list of eventDicts that overlap startDT to endDT
+        '''
+        startDT, endDT = GetDatetime(startDT), GetDatetime(endDT)
+
+        result = []
+        for start, end, eventDict in self._Candidates(startDT, endDT):
+            if start == end:
+                if startDT <= start:
+                    result.append(eventDict)
+
+            elif end > startDT:
+                result.append(eventDict)
+
+        return result
+
+    def Within(self, startDT, endDT):
+        '''
+        :return: list of eventDicts that start and end inside startDT to endDT
+        '''
+        startDT, endDT = GetDatetime(startDT), GetDatetime(endDT)
+
+        lo = bisect.bisect_left(self._starts, (startDT,))
+        hi = bisect.bisect_left(self._starts, (endDT + datetime.timedelta(microseconds=1),))
+
+        result = []
+        for start, ID, eventDict in self._starts[lo:hi]:
+            if self.GetSpan(eventDict)[1] <= endDT:
+                result.append(eventDict)
+
+        return result
+
+    def At(self, dt):
+        '''
+        :return: list of eventDicts happening at the moment dt
+        '''
+        dt = GetDatetime(dt)
+
+        result = []
+        for start, end, eventDict in self._Candidates(dt, dt + datetime.timedelta(microseconds=1)):
+            if start == end == dt or start <= dt < end:
+                result.append(eventDict)
+
+        return result
+
+    def StartingBetween(self, startDT, endDT):
+        '''
+        :return: list of eventDicts that start from startDT up to endDT, sorted by start time
+        '''
+        lo = bisect.bisect_left(self._starts, (GetDatetime(startDT),))
+        hi = bisect.bisect_left(self._starts, (GetDatetime(endDT),))
+        return [item[2] for item in self._starts[lo:hi]]
+
+    def _Candidates(self, startDT, endDT):
+        # yields (start, end, eventDict) for the events that start before endDT and could still be running at startDT
+        if not self._starts:
+            return
+
+        lo = bisect.bisect_left(self._starts, (startDT - self._durations[-1],))
+        hi = bisect.bisect_left(self._starts, (endDT,))
+
+        for index in range(lo, hi):
+            eventDict = self._starts[index][2]
+            start, end = self.GetSpan(eventDict)
+            yield start, end, eventDict
+
+    @staticmethod
+    def GetSpan(eventDict):
+        start = eventDict.get('Start Time', None) or eventDict['datetime']
+        end = eventDict.get('End Time', None) or start
+        if end < start:
+            end = start
+        return start, end
+
+
+class MetaIndexClass:
+    '''
+    Indexes the events by the value of some of their meta keys.
+    Each (metaKey, value) has its own EventIntervalIndexClass,
+        so "events in Room 101 from 10:00 to 11:30" only looks at the events in Room 101.
+    Meta values that can not be a dict key (like a list) are not indexed.
+    '''
+
+    def __init__(self, metaKeys):
+        self._indexes = collections.OrderedDict(
+            (metaKey, {}) for metaKey in metaKeys  # metaKey: {value: EventIntervalIndexClass}
+        )
+
+    def GetKeys(self):
+        return list(self._indexes)
+
+    def Add(self, eventDict):
+        for metaKey, valueIndexes in self._indexes.items():
+            value = eventDict['meta'].get(metaKey, None)
+            if value is not None and self._IsHashable(value):
+                valueIndexes.setdefault(value, EventIntervalIndexClass()).Add(eventDict)
+
+    def Remove(self, eventDict):
+        for metaKey, valueIndexes in self._indexes.items():
+            value = eventDict['meta'].get(metaKey, None)
+            if value is not None and self._IsHashable(value):
+                index = valueIndexes.get(value, None)
+                if index is not None:
+                    index.Remove(eventDict)
+                    if not len(index):
+                        del valueIndexes[value]
+
+    def Overlapping(self, metaKey, value, startDT, endDT):
+        '''
+        :return: list of eventDicts sorted by start time, or None if metaKey/value can not be answered by this index
+        '''
+        if metaKey not in self._indexes or value is None or not self._IsHashable(value):
+            return None
+
+        index = self._indexes[metaKey].get(value, None)
+        if index is None:
+            return []
+
+        return index.Overlapping(startDT, endDT)
+
+    @staticmethod
+    def _IsHashable(value):
+        try:
+            hash(value)
+        except TypeError:
+            return False
+        return True
+
+
+class TextIndexClass:
+    '''
+    An inverted index of the words in the event names and str meta values.
+    The words are kept in a sorted list, so every word that starts with a prefix is found with a bisect.
+    '''
+
+    def __init__(self):
+        self._events = {}  # word: {ID: eventDict}
+        self._words = []  # sorted list of the keys of self._events
+
+    def Add(self, eventDict):
+        for word in self.GetEventWords(eventDict):
+            events = self._events.get(word, None)
+            if events is None:
+                events = self._events[word] = {}
+                bisect.insort(self._words, word)
+            events[eventDict['ID']] = eventDict
+
+    def Remove(self, eventDict):
+        for word in self.GetEventWords(eventDict):
+            events = self._events.get(word, None)
+            if events is None:
+                continue
+
+            if events.get(eventDict['ID'], None) is eventDict:
+                del events[eventDict['ID']]
+
+            if not events:
+                del self._events[word]
+                index = bisect.bisect_left(self._words, word)
+                del self._words[index]
+
+    def Search(self, query):
+        '''
+        :param query: str
+        :return: list of the eventDicts that have a word starting with each word in query
+        '''
+        result = None
+        # the longest words match the fewest events, start with those
+        for prefix in sorted(set(self.GetWords(query)), key=len, reverse=True):
+            matches = {}
+            index = bisect.bisect_left(self._words, prefix)
+            while index < len(self._words) and self._words[index].startswith(prefix):
+                matches.update(self._events[self._words[index]])
+                index += 1
+
+            if result is None:
+                result = matches
+            else:
+                result = {ID: eventDict for ID, eventDict in result.items() if ID in matches}
+
+            if not result:
+                return []
+
+        return list((result or {}).values())
+
+    @classmethod
+    def Matches(cls, eventDict, query):
+        '''
+        Like self.Search() for one event, without an index
+        :param eventDict:
+        :param query: str
+        :return: bool True if the eventDict has a word starting with each word in query
+        '''
+        prefixes = set(cls.GetWords(query))
+        words = cls.GetEventWords(eventDict)
+        return bool(prefixes) and all(any(word.startswith(prefix) for word in words) for prefix in prefixes)
+
+    @staticmethod
+    def GetWords(text):
+        return re.findall(r'\w+', text.lower())
+
+    @classmethod
+    def GetEventWords(cls, eventDict):
+        words = set(cls.GetWords(eventDict['name'] or ''))
+        for value in eventDict['meta'].values():
+            if isinstance(value, str):
+                words.update(cls.GetWords(value))
+        return words
+
+
+class ShardWordIndexClass:
+    '''
+    Remembers which shards have each word, so a search only reads the months that can match.
+    Words are not removed when an event is, a shard that no longer has the word is just read for nothing.
+    '''
+
+    def __init__(self):
+        self._shardKeys = {}  # word: set of shardKeys
+        self._words = []  # sorted list of the keys of self._shardKeys
+
+    def Add(self, shardKey, eventDict):
+        for word in TextIndexClass.GetEventWords(eventDict):
+            shardKeys = self._shardKeys.get(word, None)
+            if shardKeys is None:
+                shardKeys = self._shardKeys[word] = set()
+                bisect.insort(self._words, word)
+            shardKeys.add(shardKey)
+
+    def Search(self, query):
+        '''
+        :param query: str
+        :return: set of the shardKeys that have a word starting with each word in query
+        '''
+        result = None
+        for prefix in set(TextIndexClass.GetWords(query)):
+            matches = set()
+            index = bisect.bisect_left(self._words, prefix)
+            while index < len(self._words) and self._words[index].startswith(prefix):
+                matches.update(self._shardKeys[self._words[index]])
+                index += 1
+
+            result = matches if result is None else result & matches
+            if not result:
+                return set()
+
+        return result or set()
+
+
 def GetDatetimeKwargs(dt):
     '''
     This converts a datetime.datetime object to a dict.
@@ -1758,3 +4391,169 @@ def GetDatetimeKwargs(dt):
          'microsecond': dt.microsecond,
          }
     return d
+
+
+def GetDatetimeFromKwargs(d):
+    '''
+    This is the reverse of GetDatetimeKwargs()
+    :param d: dict or None
+    :return: datetime.datetime or None
+    '''
+    if d is None:
+        return None
+
+    return datetime.datetime(**d)
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def GetTimestamp(dt):
+    '''
+    This converts a datetime.datetime object to the number of seconds since 1970-01-01.
+    The datetime is treated as local time, no time zone conversion is done.
+    This is a smaller way of saving a datetime.datetime as a json value than GetDatetimeKwargs()
+    :param dt: datetime.datetime or None
+    :return: int, float if dt has microseconds, or None
+    '''
+    if dt is None:
+        return None
+
+    delta = dt - EPOCH
+    timestamp = delta.days * 86400 + delta.seconds
+    if delta.microseconds:
+        timestamp += delta.microseconds / 1000000
+    return timestamp
+
+
+def GetDatetimeFromTimestamp(timestamp):
+    '''
+    This is the reverse of GetTimestamp()
+    :param timestamp: int, float or None
+    :return: datetime.datetime or None
+    '''
+    if timestamp is None:
+        return None
+
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+def GetDatetime(dt):
+    '''
+    This converts a datetime.date to a datetime.datetime at midnight.
+    datetime.datetime objects are returned as is.
+    :param dt: datetime.datetime or datetime.date
+    :return: datetime.datetime
+    '''
+    if isinstance(dt, datetime.datetime):
+        return dt
+
+    return datetime.datetime(dt.year, dt.month, dt.day)
+
+
+def GetDateKey(dt):
+    '''
+    This converts a datetime.datetime or datetime.date object to a datetime.date.
+    This is useful as a dict key for grouping events by day
+    :param dt: datetime.datetime or datetime.date
+    :return: datetime.date
+    '''
+    return datetime.date(dt.year, dt.month, dt.day)
+
+
+def GetRecurrenceDict(recurrence):
+    '''
+    Checks a recurrence rule and fills in the defaults.
+    :param recurrence: dict like {'freq': 'weekly', 'interval': 1, 'count': 10, 'until': datetime.datetime, 'exdates': [datetime.date]}
+        'freq' - 'daily', 'weekly' or 'monthly'
+        'interval' - int, 2 with 'weekly' means every other week
+        'count' - int or None, the number of occurrences
+        'until' - datetime.datetime, datetime.date (midnight) or None, no occurrences start after this
+        'exdates' - list of datetime.date that are skipped
+    :return: dict
+    '''
+    freq = str(recurrence['freq']).lower()
+    if freq not in ('daily', 'weekly', 'monthly'):
+        raise Exception('Recurrence "freq" must be "daily", "weekly" or "monthly", not {}'.format(recurrence['freq']))
+
+    count = recurrence.get('count', None)
+    until = recurrence.get('until', None)
+
+    return {
+        'freq': freq,
+        'interval': max(int(recurrence.get('interval', None) or 1), 1),
+        'count': None if count is None else int(count),
+        'until': None if until is None else GetDatetime(until),
+        'exdates': sorted(set(GetDateKey(date) for date in recurrence.get('exdates', None) or [])),
+    }
+
+
+def IterRecurrenceStarts(startDT, recurrence, windowStart, windowEnd, duration=None):
+    '''
+    Yields the start of each occurrence of a recurring event that falls in windowStart to windowEnd.
+    This jumps straight to the first occurrence near the window instead of walking the whole series.
+    :param startDT: datetime.datetime - the start of the first occurrence
+    :param recurrence: dict from GetRecurrenceDict()
+    :param windowStart: datetime.datetime
+    :param windowEnd: datetime.datetime
+    :param duration: datetime.timedelta or None - if given, occurrences that started before windowStart but are still running are included
+    :return: generator of datetime.datetime
+    '''
+    if duration is None:
+        duration = datetime.timedelta(0)
+
+    freq = recurrence['freq']
+    interval = recurrence['interval']
+    count = recurrence['count']
+    until = recurrence['until']
+    exdates = set(recurrence['exdates'])
+
+    earliest = windowStart - duration
+    if freq == 'monthly':
+        months = (earliest.year - startDT.year) * 12 + earliest.month - startDT.month
+        n = max(months // interval - 1, 0)
+        # a month that doesnt have that day (the 31st for example) has no occurrence, so it is not counted
+        generated = n if count is None else sum(1 for i in range(n) if AddMonths(startDT, i * interval) is not None)
+    else:
+        step = datetime.timedelta(days=interval * (7 if freq == 'weekly' else 1))
+        n = max((earliest - startDT) // step, 0)
+        generated = n
+
+    while count is None or generated < count:
+        if freq == 'monthly':
+            dt = AddMonths(startDT, n * interval)
+            if dt is None:
+                n += 1
+                continue
+        else:
+            dt = startDT + n * step
+
+        if dt >= windowEnd:
+            return
+
+        if until is not None and dt > until:
+            return
+
+        if dt >= windowStart or dt + duration > windowStart:
+            if GetDateKey(dt) not in exdates:
+                yield dt
+
+        n += 1
+        generated += 1
+
+
+def AddMonths(dt, months):
+    '''
+    Returns the same day and time a number of months later.
+    :param dt: datetime.datetime
+    :param months: int
+    :return: datetime.datetime, or None if that month doesnt have that day (the 31st for example)
+    '''
+    month = dt.month - 1 + months
+    year = dt.year + month // 12
+    month = month % 12 + 1
+
+    if dt.day > calendar.monthrange(year, month)[1]:
+        return None
+
+    return dt.replace(year=year, month=month)